@@ -1,13 +1,13 @@
 import os
 
+import click
 from flask import Flask
-from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
 
 from config import Config
 
 db = SQLAlchemy()
-migrate = Migrate()
 
 
 def create_app(config_class=Config):
@@ -15,13 +15,32 @@ def create_app(config_class=Config):
     app.config.from_object(config_class)
 
     db.init_app(app)
-    migrate.init_app(app, db)
+    init_sqlite(app)
+
+    # only needed by the web app and its flask db commands (see headless.py)
+    from flask_migrate import Migrate
+    Migrate(app, db)
 
     from routes import bp
     app.register_blueprint(bp)
 
     check_dirs()
 
+    if app.config["QUERY_COUNT_HEADER"]:
+        from instrumentation import init_query_count_header
+        init_query_count_header(app)
+
+    if app.config["METRICS"]:
+        from metrics import init_metrics
+        init_metrics(app)
+
+    @app.cli.command("rehash-movies")
+    def rehash_movies_command():
+        """recomputes the object hash of every stored movie (once, after upgrading from md5 hashes)"""
+
+        from store import rehash_movies
+        click.echo(f"rehashed {rehash_movies()} movies")
+
     @app.shell_context_processor
     def make_shell_context():
         from models import Source, Movie, File
@@ -31,6 +50,43 @@ def create_app(config_class=Config):
     return app
 
 
+sqlite_synchronous_modes = {"OFF", "NORMAL", "FULL", "EXTRA"}
+
+
+def init_sqlite(app):
+    """sets the pragmas configured by the SQLITE_* settings on every new connection to app's (sqlite) database"""
+
+    set_sqlite_pragmas(db.get_engine(app), app.config)
+
+
+def set_sqlite_pragmas(engine, config):
+    """sets the pragmas configured by the SQLITE_* settings of config on every new connection to engine (if sqlite)"""
+
+    if engine.dialect.name != "sqlite":
+        return
+
+    synchronous = config["SQLITE_SYNCHRONOUS"].upper()
+    if synchronous not in sqlite_synchronous_modes:
+        raise ValueError(f"invalid SQLITE_SYNCHRONOUS {config['SQLITE_SYNCHRONOUS']!r}")
+
+    pragmas = [
+        f"PRAGMA synchronous = {synchronous}",
+        f"PRAGMA cache_size = {-int(config['SQLITE_CACHE_SIZE'])}",  # negative sizes are in KiB rather than pages
+        f"PRAGMA mmap_size = {int(config['SQLITE_MMAP_SIZE'])}",
+        f"PRAGMA busy_timeout = {int(config['SQLITE_BUSY_TIMEOUT'])}",
+    ]
+    if config["SQLITE_WAL"]:
+        # (persistent, but only takes effect for file databases)
+        pragmas.insert(0, "PRAGMA journal_mode = WAL")
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+
 def check_dirs():
     if not os.path.isdir("static"):
         os.mkdir("static")
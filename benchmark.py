@@ -0,0 +1,603 @@
+"""
+benchmarks for the hot paths of scanning, run with: python benchmark.py [benchmark ...] [--size N] [--seed N]
+[--save-baseline FILE] [--baseline FILE]
+
+results (throughput and peak memory of each stage) can be saved as a baseline that later runs are compared against
+"""
+import argparse
+import copy
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import utils
+
+words = ["The", "Matrix", "Alien", "Heat", "Return", "of", "the", "King", "Blade", "Runner", "Toy", "Story", "Cats",
+         "Tsunami", "Extended", "Directors", "Cut", "Webster", "Scream", "Limitless", "Amélie", "Léon", "Dune", "II",
+         "Part", "2", "Édition", "Hevcon"]
+resolutions = ["1080p", "720p", "2160p", "480p", "1080P", ""]
+tags = [tag for category in [utils.sources, utils.editions, utils.codecs] for tag in category]
+separators = [".", " ", "_", "-"]
+extensions = [".mkv", ".mp4", ".avi", ".srt", ".nfo", ""]
+
+
+def generate_filenames(count, seed=0):
+    """generates a corpus of scene style filenames (including awkward casing and tags hidden inside words)"""
+
+    rand = random.Random(seed)
+
+    names = []
+    for _ in range(count):
+        parts = rand.sample(words, rand.randint(1, 4))
+        parts.append(str(rand.randint(1890, utils.current_year + 2)))
+        parts.append(rand.choice(resolutions))
+        for tag in rand.sample(tags, rand.randint(0, 3)):
+            parts.insert(rand.randint(0, len(parts)), rand.choice([tag, tag.upper(), tag.lower(), tag.title()]))
+
+        name = rand.choice(separators).join(part for part in parts if part)
+        if rand.random() < 0.2:
+            name = "[" + name + "]" if rand.random() < 0.5 else "(" + name + ")"
+        names.append(name + rand.choice(extensions))
+
+    return names
+
+
+def generate_tree(root, count, seed=0):
+    """
+    generates a library of (empty) files under root laid out like a real one - a directory per movie (grouped by
+    initial) holding the movie itself and often a sample, subtitles or an nfo and sometimes an extras directory
+    returns the number of files generated
+    """
+
+    rand = random.Random(seed)
+
+    generated = 0
+    while generated < count:
+        name = rand.choice(generate_filenames(1, rand.random()))
+        name = os.path.splitext(name)[0].strip("[]() ") or "untitled"
+        directory = os.path.join(root, name[0].upper(), f"{name}-{generated}")
+        os.makedirs(directory)
+
+        files = [name + rand.choice([".mkv", ".mp4", ".avi"])]
+        if rand.random() < 0.3:
+            files.append("sample-" + name + ".mkv")
+        if rand.random() < 0.3:
+            files.append(name + ".srt")
+        if rand.random() < 0.5:
+            files.append(name + ".nfo")
+
+        for filename in files[:count - generated]:
+            open(os.path.join(directory, filename), "w").close()
+        generated += min(len(files), count - generated)
+
+        if generated < count and rand.random() < 0.1:
+            os.makedirs(os.path.join(directory, "Extras"))
+            open(os.path.join(directory, "Extras", "Behind The Scenes.mkv"), "w").close()
+            generated += 1
+
+    return generated
+
+
+def legacy_parse_tag(name, tags_, case_sensitive_boundary=False):
+    """the original tag by tag search (kept as a reference for parse_tags)"""
+
+    for tag in tags_:
+        name_lower = name.lower()
+        try:
+            tag_index = name_lower.index(tag.lower())
+            if (name if case_sensitive_boundary else name_lower)[tag_index - 1] not in utils.letters:
+                return tags_[tag], name[tag_index:tag_index + len(tag)]
+        except ValueError:
+            pass
+
+    return "", ""
+
+
+def legacy_parse_tags(name):
+    return (legacy_parse_tag(name, utils.sources),
+            legacy_parse_tag(name, utils.editions, case_sensitive_boundary=True),
+            legacy_parse_tag(name, utils.codecs))
+
+
+def legacy_parse_year(name):
+    """the original sliding window year search (kept as a reference for parse_year)"""
+
+    length, i, year = len(name), int(4), int()
+    while i < length + 1:
+        try:
+            int(name[i - 4:i])
+            if name[i].lower() != 'p' and name[i - 1] != ' ' and name[i - 4] != ' ' and i != 4:
+                year = name[i - 4:i]
+                if 1900 <= int(year) <= utils.current_year:
+                    break
+                else:
+                    year = ""
+        except ValueError:
+            pass
+        except IndexError:
+            try:
+                year = name[i - 4:i] if len(str(abs(int(name[i - 4:i])))) == 4 else ""
+                if 1900 <= int(year) <= utils.current_year:
+                    break
+                else:
+                    year = ""
+            except ValueError:
+                year = ""
+        i += 1
+
+    return year if year != 0 else ""
+
+
+def legacy_parse_resolution(name):
+    """the original sliding window resolution search (kept as a reference for parse_resolution)"""
+
+    length, i, resolution = len(name), int(4), int()
+    while i < length + 1:
+        try:
+            int(name[i - 4:i])
+            if name[i].lower() == 'p':
+                resolution = name[i - 4:i + 1].strip(' ')
+                return resolution.lower() if resolution != 0 else ""
+        except ValueError:
+            pass
+        except IndexError:
+            pass
+        i += 1
+
+    return ""
+
+
+def generate_awkward_names(count, seed=0):
+    """
+    generates short random strings of the characters the year and resolution parsers are sensitive to (digits, including
+    non ascii ones, whitespace, signs, underscores and p) to compare them against the original parsers
+    """
+
+    rand = random.Random(seed)
+    alphabet = "0123456789" * 4 + "12p P-+_ x\t\x1c\u0661\u0669\uff11"
+    return ["".join(rand.choice(alphabet) for _ in range(rand.randint(0, 12))) for _ in range(count)]
+
+
+# golden corpus of names, folders and files with what the original parser made of them (also run by the tests)
+golden_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests", "fixtures", "parser_golden.json")
+
+
+def load_golden():
+    with open(golden_path, encoding="utf-8") as golden_file:
+        return json.load(golden_file)
+
+
+def bench_parsers(size, seed):
+    """regex year and resolution parsing (utils.parse_year and parse_resolution) against the sliding window originals"""
+
+    names = [utils.parse_name(name) for name in generate_filenames(size, seed)] + generate_awkward_names(size, seed)
+
+    mismatches = []
+    for label, legacy_function, function in [("year", legacy_parse_year, utils.parse_year),
+                                             ("resolution", legacy_parse_resolution, utils.parse_resolution)]:
+        legacy, legacy_time = timed(lambda: [legacy_function(name) for name in names])
+        current, current_time = timed(lambda: [function(name) for name in names])
+
+        mismatches += [(label, name, a, b) for name, a, b in zip(names, legacy, current) if a != b]
+
+        report(f"{label} (legacy)", len(names), legacy_time)
+        report(label, len(names), current_time)
+        print(f"  speedup: {legacy_time / current_time:.1f}x")
+
+    for entry in load_golden()["names"]:
+        name, year, resolution = entry["name"], entry["year"], entry["resolution"]
+        if utils.parse_year(name) != year:
+            mismatches.append(("golden year", name, year, utils.parse_year(name)))
+        if utils.parse_resolution(name) != resolution:
+            mismatches.append(("golden resolution", name, resolution, utils.parse_resolution(name)))
+
+    for label, name, expected, actual in mismatches[:10]:
+        print(f"  {label} mismatch for {name!r}: expected {expected!r}, got {actual!r}")
+    print(f"  mismatches: {len(mismatches)}")
+
+    return not mismatches
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def legacy_parse_folder_tags(folder_name):
+    """the original folder tags - its source matched in the raw name, its edition and codec once cleaned up"""
+
+    cleaned = utils.parse_name(folder_name)
+    return (legacy_parse_tag(folder_name, utils.sources),
+            legacy_parse_tag(cleaned, utils.editions, case_sensitive_boundary=True),
+            legacy_parse_tag(cleaned, utils.codecs))
+
+
+def folder_tags(folder_name):
+    parsed = utils.parse_file("movie.mkv", folder_name)
+    return ((parsed.dir_source, parsed.dir_source_tag), (parsed.dir_edition, parsed.dir_edition_tag),
+            (parsed.dir_codec, parsed.dir_codec_tag))
+
+
+# number of times each stage is timed (the fastest run is reported, which is the least affected by noise)
+repeat = 3
+
+# whether stages are run a second time (with tracemalloc, which slows them down) to measure their peak memory
+measure_memory = True
+
+# name: {"items", "seconds", "items_per_second", "peak_memory"} of every stage run
+results = {}
+
+
+def measure(name, size, function, setup=None):
+    """
+    times function (reporting it as a stage processing size items, best of repeat runs) and measures its peak memory
+    with another run, setup (if given) is called before each run (untimed) and its result passed to function
+    returns the result of the first run
+    """
+
+    result, seconds = timed(function, *([setup()] if setup else []))
+    for _ in range(repeat - 1):
+        seconds = min(seconds, timed(function, *([setup()] if setup else []))[1])
+
+    peak = None
+    if measure_memory:
+        arguments = [setup()] if setup else []
+        tracemalloc.start()
+        try:
+            function(*arguments)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    report(name, size, seconds, peak)
+
+    return result
+
+
+def bench_tags(size, seed):
+    """single pass tag matching (utils.parse_tags) against the original per tag search"""
+
+    names = generate_filenames(size, seed)
+
+    legacy, legacy_time = timed(lambda: [legacy_parse_tags(name) for name in names])
+    current, current_time = timed(lambda: [utils.parse_tags(name) for name in names])
+
+    mismatches = [(name, a, b) for name, a, b in zip(names, legacy, current) if a != b]
+
+    # folder names keep the original's mix of raw and cleaned up matching
+    folders = [os.path.splitext(name)[0] for name in names]
+    mismatches += [(folder, legacy_parse_folder_tags(folder), folder_tags(folder)) for folder in folders
+                   if legacy_parse_folder_tags(folder) != folder_tags(folder)]
+    for entry in load_golden()["folders"]:
+        expected = (entry["source"], entry["edition"], entry["codec"])
+        actual = tuple(tag for tag, _ in folder_tags(entry["folder"]))
+        if actual != expected:
+            mismatches.append((entry["folder"], expected, actual))
+
+    for name, expected, actual in mismatches[:10]:
+        print(f"  mismatch for {name!r}: expected {expected}, got {actual}")
+
+    report("tags (legacy)", size, legacy_time)
+    report("tags", size, current_time)
+    print(f"  speedup: {legacy_time / current_time:.1f}x, mismatches: {len(mismatches)}")
+
+    return not mismatches
+
+
+def bench_functions(size, seed):
+    """the individual filename parsers on (cleaned up) scene style names"""
+
+    names = [utils.parse_name(name) for name in generate_filenames(size, seed)]
+
+    for function in [utils.parse_year, utils.parse_resolution, utils.parse_source, utils.parse_tags]:
+        measure(function.__name__, size, lambda: [function(name) for name in names])
+
+    return True
+
+
+def bench_stages(size, seed):
+    """
+    each stage of the streaming scan pipeline (walk, parse, flatten and upsert) on a generated library of size files
+    """
+
+    from scanner import iter_source_files
+
+    directory = tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        root = os.path.join(directory, "library")
+        _, seconds = timed(generate_tree, root, size, seed)
+        print(f"  generated {size} files in {seconds:.1f}s")
+
+        entries = measure("walk", size, lambda: list(iter_source_files([root], workers=1)))
+        pairs = [(filename, os.path.basename(path)) for path, filename in entries]
+        # parsing starts from an empty parse cache, then again with the cache warm (as a rescan would)
+        parsed = measure("parse", size, lambda _: utils.parse_files(pairs, workers=1), setup=utils.parse_cache.clear)
+        measure("parse (cached)", size, lambda: utils.parse_files(pairs, workers=1))
+        movies = measure("flatten", size, lambda: list(utils.mark_chunk(entries, parsed)))
+
+        with benchmark_app(directory).app_context():
+            from app import db
+            from models import Source
+            from store import scan_and_store, store_movies
+
+            # each run stores into an empty database (and parses with an empty parse cache)
+            def empty_database():
+                db.drop_all()
+                db.create_all()
+                utils.parse_cache.clear()
+
+            measure("upsert", len(movies), lambda _: store_movies(iter(movies)), setup=empty_database)
+            measure("upsert (unchanged)", len(movies), lambda: store_movies(iter(movies)))
+            measure("scan_and_store", size, lambda _: scan_and_store(Source(root)), setup=empty_database)
+
+        return True
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_records(size, seed):
+    """memory held by the parsed files and scanned movies of size files as records against the dicts they replaced"""
+
+    names = generate_filenames(size, seed)
+    folders = [os.path.splitext(name)[0] for name in generate_filenames(size // 3 + 1, seed + 1)]
+    pairs = [(os.path.splitext(name)[0] + ".mkv", folders[i // 3]) for i, name in enumerate(names)]
+
+    # parsed up front so that only the records themselves are measured
+    parsed = utils.parse_files(pairs, workers=1)
+    movies = [utils.mark_movie(folder, item, values) for (item, folder), values in zip(pairs, parsed)]
+
+    def held(build):
+        """memory allocated by build that is still held by what it returns (measured regardless of measure_memory)"""
+        tracemalloc.start()
+        try:
+            built = build()  # kept alive until it has been measured
+            return tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+
+    for label, records, dicts in [("parsed files", lambda: [utils.ParsedFile(*values) for values in parsed],
+                                   lambda: [values._asdict() for values in parsed]),
+                                  ("scanned movies", lambda: [utils.ScannedMovie(*movie) for movie in movies],
+                                   lambda: [movie.as_dict() for movie in movies])]:
+        records_size, dicts_size = held(records), held(dicts)
+        print(f"{label:<24} {size:>9} items {records_size / 2 ** 20:>9.1f} MiB as records "
+              f"{dicts_size / 2 ** 20:>9.1f} MiB as dicts ({1 - records_size / dicts_size:.0%} saved)")
+        results[label] = {"items": size, "seconds": None, "items_per_second": None, "peak_memory": records_size}
+
+    return True
+
+
+def bench_legacy(size, seed):
+    """the nested (non streaming) scan - scan_sources, process_files and flatten_movie_results"""
+
+    from scanner import scan_sources
+
+    directory = tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        root = os.path.join(directory, "library")
+        generate_tree(root, size, seed)
+
+        structure = measure("scan_sources", size, lambda: scan_sources([root], workers=1)[0])
+        # both work in place, so each run gets a fresh copy (and process_files an empty parse cache)
+        def fresh_structure():
+            utils.parse_cache.clear()
+            return copy.deepcopy(structure)
+
+        files = measure("process_files", size, utils.process_files, setup=fresh_structure)
+        measure("flatten_movie_results", size, utils.flatten_movie_results, setup=lambda: copy.deepcopy(files))
+
+        return True
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_concurrency(size, seed):
+    """
+    stress test of listing requests made while a full scan of size files is storing, with and without write ahead
+    logging - with it no request should fail or wait on the scan's writes
+    """
+
+    directory = tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        root = os.path.join(directory, "library")
+        generate_tree(root, size, seed)
+
+        ok = True
+        for label, wal in [("wal", True), ("rollback journal", False)]:
+            database_directory = tempfile.mkdtemp(dir=directory)
+            app = benchmark_app(database_directory, SQLITE_WAL=wal)
+
+            failed = stress_listing(app, root, f"listing during scan ({label})")
+            ok = ok and not (wal and failed)
+
+        return ok
+    finally:
+        shutil.rmtree(directory)
+
+
+def stress_listing(app, root, name):
+    """
+    makes listing requests (alternately filtered and unfiltered) to app until a scan of root has been stored, reports
+    their latencies, returns the number of requests that failed
+    """
+
+    import threading
+
+    from app import db
+    from models import Source
+    from store import scan_and_store
+
+    with app.app_context():
+        db.create_all()
+
+    def scan():
+        with app.app_context():
+            scan_and_store(Source(root))
+            db.session.remove()
+
+    utils.parse_cache.clear()
+    scanner = threading.Thread(target=scan)
+
+    client, latencies, failed = app.test_client(), [], 0
+    start = time.perf_counter()
+    scanner.start()
+    while scanner.is_alive():
+        url = "/api/movies?limit=50" + ("&resolution=1080p" if len(latencies) % 2 else "")
+        response, seconds = timed(client.get, url)
+        latencies.append(seconds)
+        failed += response.status_code != 200
+    scanner.join()
+    seconds = time.perf_counter() - start
+
+    latencies.sort()
+    print(f"{name:<36} {len(latencies):>6} requests in {seconds:.1f}s ({failed} failed), latency median "
+          f"{latencies[len(latencies) // 2] * 1000:.1f}ms, p95 {latencies[int(len(latencies) * 0.95)] * 1000:.1f}ms, "
+          f"max {latencies[-1] * 1000:.1f}ms")
+    results[name] = {"items": len(latencies), "seconds": seconds, "items_per_second": len(latencies) / seconds,
+                     "peak_memory": None}
+
+    return failed
+
+
+def bench_startup(size, seed):
+    """
+    time taken (best of repeat runs, in a new interpreter) to get to running a scan without an app (as cli.py
+    does) against creating the web app
+    """
+
+    package = os.path.dirname(os.path.abspath(__file__))
+    programs = [
+        ("startup (headless scan)", "from headless import init_headless; import store; init_headless()"),
+        ("startup (web app)", "from app import create_app; create_app()"),
+    ]
+
+    directory = tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        for name, program in programs:
+            command = [sys.executable, "-c", f"import sys; sys.path.insert(0, {package!r}); {program}"]
+            # run in an empty directory as the web app creates its static directories in the working directory
+            seconds = min(timed(lambda: subprocess.run(command, cwd=directory, check=True))[1] for _ in range(repeat))
+            report(name, 1, seconds)
+
+        return True
+    finally:
+        shutil.rmtree(directory)
+
+
+def benchmark_app(directory, **settings):
+    """an app storing into a database in directory (with settings overriding its config)"""
+
+    from app import create_app
+    from config import Config
+
+    class BenchmarkConfig(Config):
+        SQLALCHEMY_DATABASE_URI = "sqlite:///" + os.path.join(directory, "benchmark.db")
+        SQLALCHEMY_TRACK_MODIFICATIONS = False
+        TMDB_CACHE_PATH = None
+        SNAPSHOT_PATH = None
+        PARSE_CACHE_PATH = None
+
+    for name, value in settings.items():
+        setattr(BenchmarkConfig, name, value)
+
+    return create_app(BenchmarkConfig)
+
+
+def report(name, size, seconds, peak=None):
+    results[name] = {"items": size, "seconds": seconds, "items_per_second": size / seconds, "peak_memory": peak}
+
+    memory = f" {peak / 2 ** 20:>9.1f} MiB peak" if peak is not None else ""
+    print(f"{name:<24} {size:>9} items {seconds:>9.3f}s {size / seconds:>12.0f} items/s{memory}")
+
+
+def compare(baseline, tolerance):
+    """
+    prints the change in throughput and peak memory of each stage against baseline
+    returns False if any of them regressed by more than tolerance (a fraction)
+    """
+
+    ok = True
+    print(f"\ncompared to baseline (size {baseline['size']}, seed {baseline['seed']}):")
+    for name, result in results.items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+
+        regressed, line = False, f"  {name:<24}"
+        if result["items_per_second"] is not None and base["items_per_second"]:
+            throughput = result["items_per_second"] / base["items_per_second"] - 1
+            regressed = throughput < -tolerance
+            line += f" throughput {throughput:>+7.1%}"
+
+        if result["peak_memory"] is not None and base["peak_memory"]:
+            memory = result["peak_memory"] / base["peak_memory"] - 1
+            regressed = regressed or memory > tolerance
+            line += f"  peak memory {memory:>+7.1%}"
+
+        print(line + ("  REGRESSED" if regressed else ""))
+        ok = ok and not regressed
+
+    return ok
+
+
+benchmarks = {
+    "tags": bench_tags,
+    "parsers": bench_parsers,
+    "functions": bench_functions,
+    "records": bench_records,
+    "stages": bench_stages,
+    "legacy": bench_legacy,
+    "concurrency": bench_concurrency,
+    "startup": bench_startup,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("benchmarks", nargs="*", metavar="benchmark",
+                        help=f"any of: {', '.join(benchmarks)} (default: all)")
+    parser.add_argument("--size", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="times each stage is timed (default: 3)")
+    parser.add_argument("--no-memory", action="store_true", help="don't measure peak memory (halves the run time)")
+    parser.add_argument("--save-baseline", metavar="FILE", help="save the results as a baseline")
+    parser.add_argument("--baseline", metavar="FILE", help="compare the results against a saved baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="fraction a stage may regress by before the comparison fails (default: 0.1)")
+    args = parser.parse_args()
+
+    for name in args.benchmarks:
+        if name not in benchmarks:
+            parser.error(f"unknown benchmark {name!r}")
+
+    global repeat, measure_memory
+    repeat, measure_memory = max(1, args.repeat), not args.no_memory
+
+    ok = True
+    for name in args.benchmarks or benchmarks:
+        print(f"{name}:")
+        ok = benchmarks[name](args.size, args.seed) and ok
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if (baseline["size"], baseline["seed"]) != (args.size, args.seed):
+            print(f"warning: the baseline was run with size {baseline['size']} and seed {baseline['seed']}")
+        ok = compare(baseline, args.tolerance) and ok
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as baseline_file:
+            json.dump({"size": args.size, "seed": args.seed, "results": results}, baseline_file, indent=2)
+
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,117 @@
+"""
+headless command line interface for scanning, enrichment and image downloads (e.g. from cron or a worker container)
+
+    python cli.py [--database URI] scan [--incremental] [--source PATH ...]
+    python cli.py enrich [--limit N]
+    python cli.py rebuild-thumbnails [--refresh]
+
+settings are read from the environment (see config.Config) and can be overridden by arguments, commands only import
+what they need so that startup stays fast
+
+commands don't create a Flask app - scans and enrichment run on a plain sqlalchemy session and read their settings from
+the config (see headless.init_headless)
+"""
+import argparse
+import datetime
+import logging
+import sys
+import time
+
+started = time.perf_counter()
+
+logger = logging.getLogger("cli")
+
+
+def scan(args):
+    from headless import session
+    from models import Source
+    from store import scan_and_store
+
+    sources = [Source(address) for address in args.source] if args.source else session.query(Source).all()
+    scan_and_store(*sources, incremental=args.incremental, workers=args.workers, timeout=args.timeout,
+                   parse_workers=args.parse_workers, batch_size=args.batch_size)
+
+    logger.info("scanned %s sources", len(sources))
+
+
+def enrich(args):
+    from enrich import enrich_movies
+    from tmdb import get_cache
+
+    matched = enrich_movies(workers=args.workers, batch_size=args.batch_size,
+                            recheck_after=datetime.timedelta(days=args.recheck_days), limit=args.limit)
+
+    logger.info("matched %s movies", matched)
+    if get_cache() is not None:
+        logger.info("tmdb response cache: %s", get_cache().stats())
+
+
+def rebuild_thumbnails(args):
+    from app import check_dirs
+    from images import download_movie_images
+
+    check_dirs()
+    downloaded = download_movie_images(workers=args.workers, batch_size=args.batch_size, refresh=args.refresh)
+
+    logger.info("downloaded images of %s films", downloaded)
+
+
+def parse_args(argv, config):
+    parser = argparse.ArgumentParser(description=__doc__.strip(), formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database", default=config.SQLALCHEMY_DATABASE_URI,
+                        help="database uri (default: SQLALCHEMY_DATABASE_URI)")
+    parser.add_argument("--log-level", default="INFO")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    scan_parser = commands.add_parser("scan", help="scans the sources and stores their movies")
+    scan_parser.set_defaults(function=scan)
+    scan_parser.add_argument("--incremental", action="store_true",
+                             help="only list changed directories and parse new or changed files")
+    scan_parser.add_argument("--source", action="append", metavar="PATH",
+                             help="scans PATH instead of the stored sources (can be given more than once)")
+    scan_parser.add_argument("--workers", type=int, default=config.SCAN_WORKERS)
+    scan_parser.add_argument("--timeout", type=float, default=config.SCAN_TIMEOUT)
+    scan_parser.add_argument("--parse-workers", type=int, default=config.PARSE_WORKERS)
+    scan_parser.add_argument("--batch-size", type=int, default=config.SCAN_BATCH_SIZE)
+
+    enrich_parser = commands.add_parser("enrich", help="looks up unmatched movies on TMDB")
+    enrich_parser.set_defaults(function=enrich)
+    enrich_parser.add_argument("--workers", type=int, default=config.TMDB_WORKERS)
+    enrich_parser.add_argument("--batch-size", type=int, default=config.TMDB_BATCH_SIZE)
+    enrich_parser.add_argument("--recheck-days", type=int, default=config.TMDB_RECHECK_DAYS)
+    enrich_parser.add_argument("--limit", type=int, help="looks up at most this many movies")
+
+    thumbnails_parser = commands.add_parser("rebuild-thumbnails",
+                                            help="downloads the posters and thumbnails of matched movies missing them")
+    thumbnails_parser.set_defaults(function=rebuild_thumbnails)
+    thumbnails_parser.add_argument("--workers", type=int, default=config.IMAGE_WORKERS)
+    thumbnails_parser.add_argument("--batch-size", type=int, default=50)
+    thumbnails_parser.add_argument("--refresh", action="store_true",
+                                   help="downloads the images of every matched movie again")
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    from config import Config
+
+    args = parse_args(argv, Config)
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    class CliConfig(Config):
+        SQLALCHEMY_DATABASE_URI = args.database
+
+    from headless import init_headless, session
+
+    init_headless(CliConfig)
+    try:
+        logger.debug("started %s in %.3fs", args.command, time.perf_counter() - started)
+        args.function(args)
+    finally:
+        session.remove()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
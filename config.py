@@ -3,8 +3,91 @@ import os
 
 class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get("SQLALCHEMY_DATABASE_URI", "sqlite:///app.db")
-    SQLALCHEMY_TRACK_MODIFICATIONS = True
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # sqlite connections use write ahead logging (so that reads never wait on a scan writing) unless SQLITE_WAL is 0,
+    # with SQLITE_SYNCHRONOUS syncing, SQLITE_CACHE_SIZE KiB of page cache, up to SQLITE_MMAP_SIZE bytes of the database
+    # memory mapped and waiting up to SQLITE_BUSY_TIMEOUT milliseconds for another writer's lock
+    SQLITE_WAL = os.environ.get("SQLITE_WAL", "1") != "0"
+    SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+    SQLITE_CACHE_SIZE = int(os.environ.get("SQLITE_CACHE_SIZE", 64 * 1024))
+    SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get("SQLITE_BUSY_TIMEOUT", 5000))
+
+    # json responses at least this size (in bytes) are compressed
+    COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", 1024))
+
+    # the unfiltered library listing is served from an in memory snapshot, which is also persisted to SNAPSHOT_PATH (if
+    # set) so that it doesn't have to be rebuilt from scratch after a restart
+    SNAPSHOT_PATH = os.environ.get("SNAPSHOT_PATH")
+
+    # adds an X-Query-Count header (number of sql statements executed) to every response
+    QUERY_COUNT_HEADER = os.environ.get("QUERY_COUNT_HEADER") == "1"
+
+    # request, scan stage, sql statement and TMDB request timings are recorded and exposed (as prometheus text) at
+    # /metrics unless METRICS is 0
+    METRICS = os.environ.get("METRICS", "1") != "0"
+
+    # with metrics enabled, every request is profiled if PROFILE is 1 (or only those sent with an X-Profile header if
+    # PROFILE_HEADER is 1) and the profile saved to PROFILE_DIR, its file name is returned in an X-Profile header
+    PROFILE = os.environ.get("PROFILE") == "1"
+    PROFILE_HEADER = os.environ.get("PROFILE_HEADER") == "1"
+    PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
 
     TMDB_BASE_URL = "https://api.themoviedb.org/3/"
     TMDB_IMAGE_URL = "https://image.tmdb.org/t/p/"
     TMDB_API_KEY = os.environ.get("TMDB_API_KEY")
+
+    # requests to TMDB are limited to TMDB_REQUESTS_PER_SECOND (across all threads), failed requests are retried up to
+    # TMDB_MAX_RETRIES times backing off exponentially from TMDB_BACKOFF seconds
+    TMDB_REQUESTS_PER_SECOND = float(os.environ.get("TMDB_REQUESTS_PER_SECOND", 20))
+    TMDB_MAX_RETRIES = int(os.environ.get("TMDB_MAX_RETRIES", 3))
+    TMDB_BACKOFF = float(os.environ.get("TMDB_BACKOFF", 0.5))
+    TMDB_TIMEOUT = float(os.environ.get("TMDB_TIMEOUT", 10))
+
+    # API responses are cached in TMDB_CACHE_PATH (an sqlite database, caching is disabled if empty) for the TTL (in
+    # seconds) of their endpoint, keeping the TMDB_CACHE_MAX_ENTRIES most recently used
+    TMDB_CACHE_PATH = os.environ.get("TMDB_CACHE_PATH", "tmdb_cache.db")
+    TMDB_CACHE_MAX_ENTRIES = int(os.environ.get("TMDB_CACHE_MAX_ENTRIES", 100000))
+    TMDB_CACHE_TTLS = {
+        "search/movie": 7 * 24 * 60 * 60,
+        "movie": 30 * 24 * 60 * 60,
+        "movie/images": 30 * 24 * 60 * 60,
+        "default": 24 * 60 * 60,
+    }
+
+    # enrichment looks up unmatched movies on TMDB_WORKERS threads writing results back TMDB_BATCH_SIZE at a time,
+    # movies that couldn't be matched are only looked up again after TMDB_RECHECK_DAYS
+    TMDB_WORKERS = int(os.environ.get("TMDB_WORKERS", 4))
+    TMDB_BATCH_SIZE = int(os.environ.get("TMDB_BATCH_SIZE", 50))
+    TMDB_RECHECK_DAYS = int(os.environ.get("TMDB_RECHECK_DAYS", 7))
+
+    # number of images downloaded concurrently
+    IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", 4))
+
+    # number of sources walked concurrently and how long (in seconds) a single source may take before it is abandoned
+    SCAN_WORKERS = int(os.environ.get("SCAN_WORKERS", 4))
+    SCAN_TIMEOUT = float(os.environ["SCAN_TIMEOUT"]) if os.environ.get("SCAN_TIMEOUT") else None
+
+    # /local_movies scans run as background jobs on SCAN_JOB_WORKERS threads, with at most SCAN_JOB_MAX_PENDING queued
+    # or running at once and the results of the SCAN_JOBS_KEPT most recently finished kept
+    SCAN_JOB_WORKERS = int(os.environ.get("SCAN_JOB_WORKERS", 1))
+    SCAN_JOB_MAX_PENDING = int(os.environ.get("SCAN_JOB_MAX_PENDING", 4))
+    SCAN_JOBS_KEPT = int(os.environ.get("SCAN_JOBS_KEPT", 10))
+
+    # number of processes used to parse large batches of files (defaults to the number of cores)
+    PARSE_WORKERS = int(os.environ["PARSE_WORKERS"]) if os.environ.get("PARSE_WORKERS") else None
+
+    # parsed file and folder names are cached (the PARSE_CACHE_MAX_ENTRIES most recently used) and saved to
+    # PARSE_CACHE_PATH between scans (in memory only if empty)
+    PARSE_CACHE_PATH = os.environ.get("PARSE_CACHE_PATH", "parse_cache.pickle")
+    PARSE_CACHE_MAX_ENTRIES = int(os.environ.get("PARSE_CACHE_MAX_ENTRIES", 100000))
+
+    # number of scanned movies (or new and changed files when scanning incrementally) stored and committed at a time
+    SCAN_BATCH_SIZE = int(os.environ.get("SCAN_BATCH_SIZE", 1000))
+
+    # the watcher stores changes once there have been none for WATCH_DEBOUNCE seconds (or WATCH_MAX_DELAY seconds after
+    # the first), polling every WATCH_POLL_INTERVAL seconds where inotify isn't available
+    WATCH_DEBOUNCE = float(os.environ.get("WATCH_DEBOUNCE", 2))
+    WATCH_MAX_DELAY = float(os.environ.get("WATCH_MAX_DELAY", 30))
+    WATCH_POLL_INTERVAL = float(os.environ.get("WATCH_POLL_INTERVAL", 60))
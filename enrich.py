@@ -0,0 +1,187 @@
+"""
+functions for enriching stored movies with metadata from TMDB
+"""
+import datetime
+import logging
+import re
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from headless import app_context, get_app, init_headless, session, setting
+from models import Movie, TitleMatch
+from tmdb import TMDBError, search_movies, get_movie_data, get_cache
+from utils import chunked
+
+logger = logging.getLogger(__name__)
+
+
+def enrich_movies(workers=4, batch_size=50, recheck_after=datetime.timedelta(days=7), limit=None):
+    """
+    looks up unmatched movies on TMDB (concurrently on workers threads) and stores the results, batch_size at a time
+
+    copies of the same film (different resolutions, editions or samples) share their title and year, so each title and
+    year is only resolved once for all of them, and titles resolved before (see TitleMatch) aren't searched for again
+    movies that couldn't be matched are only looked up again once recheck_after has passed
+    returns the number of movies matched
+    """
+
+    app = get_app()
+
+    candidates = session.query(Movie.id, Movie.marked_title, Movie.marked_year).filter(
+        Movie.tmdb_matched == False,
+        (Movie.tmdb_last_checked == None) | (Movie.tmdb_last_checked < datetime.datetime.now() - recheck_after),
+    ).order_by(Movie.id).limit(limit).all()
+
+    # title key: (title, year) searched for and ids of the movies with that title and year
+    groups = {}
+    for movie_id, title, year in candidates:
+        groups.setdefault(title_key(title, year), ((title, year), []))[1].append(movie_id)
+
+    matched = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="enrich") as executor:
+        # submitted a chunk at a time so that results are written back while the rest are still being looked up
+        for chunk in chunked(groups.items(), batch_size * workers):
+            known = known_matches([key for key, _ in chunk], recheck_after)
+            copies = matched_copies(tmdb_id for tmdb_id in known.values() if tmdb_id is not None)
+
+            # results are (title key if it was resolved rather than known, movie ids, TMDB data, a matched copy of the
+            # film or None if it couldn't be matched)
+            results, futures = [], {}
+            for key, ((title, year), movie_ids) in chunk:
+                if key not in known:
+                    futures[executor.submit(lookup_movie, app, title, year)] = (key, movie_ids)
+                elif known[key] is None:
+                    results.append((None, movie_ids, None))
+                elif known[key] in copies:
+                    results.append((None, movie_ids, copies[known[key]]))
+                else:
+                    # every copy matched before has since been removed, so only its data has to be fetched
+                    futures[executor.submit(fetch_movie, app, known[key])] = (None, movie_ids)
+
+            for future in as_completed(futures):
+                key, movie_ids = futures[future]
+                try:
+                    results.append((key, movie_ids, future.result()))
+                except TMDBError as e:
+                    logger.warning("failed to look up movies %s: %s", movie_ids, e)
+                except Exception:
+                    # (e.g. an unexpected response) one bad lookup mustn't lose the results of the rest of the batch
+                    logger.exception("failed to look up movies %s", movie_ids)
+
+                if len(results) >= batch_size:
+                    matched += store_results(results)
+                    results = []
+
+            matched += store_results(results)
+
+    return matched
+
+
+def normalize_title(title):
+    """title in lower case without accents, punctuation or repeated spaces"""
+
+    title = unicodedata.normalize("NFKD", title or "")
+    title = "".join(character for character in title if not unicodedata.combining(character))
+
+    return " ".join(re.findall(r"\w+", title.casefold()))
+
+
+def title_key(title, year):
+    return normalize_title(title), year or ""
+
+
+def known_matches(keys, recheck_after):
+    """
+    returns title key: TMDB id (None if it didn't match) of the keys that have been resolved before, titles that didn't
+    match are left out once recheck_after has passed
+    """
+
+    keys = set(keys)
+    recheck_before = datetime.datetime.now() - recheck_after
+
+    return {
+        (match.title, match.year): match.tmdb_id
+        for match in session.query(TitleMatch).filter(TitleMatch.title.in_({title for title, _ in keys}))
+        if (match.title, match.year) in keys and (match.tmdb_id is not None or match.checked_at >= recheck_before)
+    }
+
+
+def matched_copies(tmdb_ids):
+    """returns TMDB id: a movie matched to it for tmdb_ids"""
+
+    tmdb_ids = set(tmdb_ids)
+    if not tmdb_ids:
+        return {}
+
+    return {movie.tmdb_id: movie for movie in session.query(Movie).filter(Movie.tmdb_id.in_(tmdb_ids))}
+
+
+def lookup_movie(app, title, year):
+    """finds the TMDB data of the best match for title (and year), returns None if there is no match"""
+
+    with app_context(app):
+        if not title:
+            return None
+
+        results = search_movies(title, year=year)["results"]
+        if not results and year:
+            results = search_movies(title)["results"]
+
+        if not results:
+            return None
+
+        return get_movie_data(results[0]["id"])
+
+
+def fetch_movie(app, tmdb_id):
+    with app_context(app):
+        return get_movie_data(tmdb_id)
+
+
+def store_results(results):
+    """
+    stores (title key or None, movie ids, TMDB data, a matched copy of the film or None) results and the title matches
+    of those with a title key, returns the number of movies matched
+    """
+
+    if not results:
+        return 0
+
+    now = datetime.datetime.now()
+
+    data = {}
+    for key, movie_ids, result in results:
+        for movie_id in movie_ids:
+            data[movie_id] = result
+
+        if key is not None:
+            session.merge(TitleMatch(*key, result["id"] if result is not None else None, now))
+
+    matched = 0
+    for movie_ids in chunked(data, 500):  # a result can be fanned out to any number of copies
+        for movie in session.query(Movie).filter(Movie.id.in_(movie_ids)):
+            result = data[movie.id]
+            if result is None:
+                movie.tmdb_last_checked = now
+                continue
+
+            if isinstance(result, Movie):
+                movie.copy_tmdb_general(result)
+            else:
+                movie.update_tmdb_general(result)
+            matched += 1
+
+    session.commit()
+
+    return matched
+
+
+if __name__ == '__main__':
+    init_headless()
+    logging.basicConfig(level=logging.INFO)
+
+    enrich_movies(workers=setting("TMDB_WORKERS"), batch_size=setting("TMDB_BATCH_SIZE"),
+                  recheck_after=datetime.timedelta(days=setting("TMDB_RECHECK_DAYS")))
+
+    if get_cache() is not None:
+        logger.info("tmdb response cache: %s", get_cache().stats())
@@ -0,0 +1,95 @@
+"""
+the settings and database session scans, enrichment and image downloads use - those of the current app inside an app
+context, otherwise the ones set up by init_headless (see cli.py) so that they run without creating a Flask app at all
+"""
+import os
+from contextlib import nullcontext
+
+from flask import current_app, has_app_context
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from app import db, set_sqlite_pragmas
+from config import Config
+
+# settings used outside of an app context (see configure), anything not set there is taken from Config
+settings = {}
+
+# the session used outside of an app context, bound by init_headless
+headless_session = None
+
+
+def configure(**values):
+    """sets settings used outside of an app context, e.g. configure(TMDB_API_KEY=key)"""
+
+    settings.update(values)
+
+
+def setting(name):
+    """the setting name of the current app, or (outside of an app context) as configured or from Config"""
+
+    if has_app_context():
+        return current_app.config[name]
+
+    return settings[name] if name in settings else getattr(Config, name)
+
+
+def root_path():
+    """the directory relative paths (e.g. of the caches) are relative to"""
+
+    return current_app.root_path if has_app_context() else os.path.dirname(os.path.abspath(__file__))
+
+
+def get_app():
+    """the current app (to hand to worker threads, see app_context) or None outside of an app context"""
+
+    return current_app._get_current_object() if has_app_context() else None
+
+
+def app_context(app):
+    """an app context of app (as returned by get_app) or, for None, no context at all"""
+
+    return app.app_context() if app is not None else nullcontext()
+
+
+def init_headless(config_class=Config):
+    """
+    configures the settings of config_class and binds the session used outside of an app context to a plain engine for
+    its database (with the pragmas of its SQLITE_* settings), returns the engine
+    """
+
+    global headless_session
+
+    values = {name: getattr(config_class, name) for name in dir(config_class) if name.isupper()}
+    configure(**values)
+
+    engine = create_engine(values["SQLALCHEMY_DATABASE_URI"])
+    set_sqlite_pragmas(engine, values)
+
+    if headless_session is not None:
+        headless_session.remove()
+    headless_session = scoped_session(sessionmaker(bind=engine))
+
+    return engine
+
+
+def current_session():
+    """db.session inside an app context (or if init_headless hasn't been called), otherwise the headless session"""
+
+    if has_app_context() or headless_session is None:
+        return db.session
+
+    return headless_session
+
+
+class SessionProxy:
+    """stands in for db.session, forwarding to the current_session() (also a scoped session) at the time of each use"""
+
+    def __call__(self):
+        return current_session()()
+
+    def __getattr__(self, name):
+        return getattr(current_session(), name)
+
+
+session = SessionProxy()
@@ -0,0 +1,65 @@
+"""
+http caching (conditional requests against the library version) and compression of json responses
+"""
+import gzip
+import hashlib
+
+from flask import current_app, jsonify, request
+from werkzeug.http import is_resource_modified
+
+from models import get_library_version
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def cached_json(key, build):
+    """
+    responds with the json returned by build() (a payload or an already serialized string), a strong etag derived from
+    the library version and key (e.g. the path and query) plus a last modified time so that unchanged clients get a 304
+    (without build being called)
+
+    large payloads are compressed (with brotli if it is installed and the client accepts it, otherwise gzip)
+    """
+
+    version, updated_at = get_library_version()
+    encoding = choose_encoding()
+
+    # the encoding is part of the etag as each encoding is a different representation
+    etag = hashlib.md5(f"{version}:{key}".encode("utf-8")).hexdigest() + (f"-{encoding}" if encoding else "")
+
+    if not is_resource_modified(request.environ, etag=etag, last_modified=updated_at):
+        response = current_app.response_class(status=304)
+    else:
+        payload = build()
+        if isinstance(payload, str):
+            response = current_app.response_class(payload, mimetype="application/json")
+        else:
+            response = jsonify(payload)
+        if encoding and response.content_length >= current_app.config["COMPRESS_MIN_SIZE"]:
+            compress(response, encoding)
+
+    response.set_etag(etag)
+    response.last_modified = updated_at
+    response.vary.add("Accept-Encoding")
+    # browsers and proxies may store responses but have to revalidate them (cheaply) before each use
+    response.cache_control.no_cache = True
+    response.cache_control.public = True
+
+    return response
+
+
+def choose_encoding():
+    if brotli is not None and "br" in request.accept_encodings:
+        return "br"
+    if "gzip" in request.accept_encodings:
+        return "gzip"
+    return None
+
+
+def compress(response, encoding):
+    data = response.get_data()
+    response.set_data(brotli.compress(data) if encoding == "br" else gzip.compress(data, compresslevel=6))
+    response.headers["Content-Encoding"] = encoding
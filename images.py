@@ -0,0 +1,105 @@
+"""
+functions for downloading movie images (full size posters and thumbnails for the grid) into each movie's directory
+"""
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from app import check_dirs
+from headless import app_context, get_app, init_headless, session, setting
+from models import Movie, File
+from tmdb import TMDBError, download_image, get_movie_data
+from utils import chunked
+
+logger = logging.getLogger(__name__)
+
+# (file type, TMDB size) of the images downloaded for each movie, TMDB serves each size already resized
+image_sizes = [("poster", "w500"), ("thumb", "w154")]
+
+
+def download_movie_images(workers=4, batch_size=50, refresh=False):
+    """
+    downloads the images (see image_sizes) of matched movies missing a thumbnail (or every matched movie if refresh) on
+    workers threads, recording each image as a File linked to the movies
+
+    copies of the same film share a directory so their images are only downloaded once
+    returns the number of films with images downloaded
+    """
+
+    app = get_app()
+
+    query = session.query(Movie).filter(Movie.tmdb_matched == True)
+    if not refresh:
+        query = query.filter(~Movie.files.any(File.type == "thumb"))
+
+    films = {}
+    for movie in query.order_by(Movie.id):
+        films.setdefault(movie.tmdb_id, []).append(movie)
+
+    # directories are created up front as copies (and other films) share parent directories
+    for movies in films.values():
+        movies[0].build_dir()
+
+    downloaded = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="images") as executor:
+        for chunk in chunked(list(films), batch_size):
+            futures = {executor.submit(download_images, app, tmdb_id, films[tmdb_id][0].poster_path,
+                                       films[tmdb_id][0].dir): tmdb_id for tmdb_id in chunk}
+
+            for future in as_completed(futures):
+                tmdb_id = futures[future]
+                try:
+                    result = future.result()
+                except (TMDBError, OSError) as e:
+                    logger.warning("failed to download images of tmdb movie %s: %s", tmdb_id, e)
+                    continue
+
+                if result:
+                    store_images(films[tmdb_id], *result)
+                    downloaded += 1
+
+            session.commit()
+
+    return downloaded
+
+
+def download_images(app, tmdb_id, poster_path, directory):
+    """
+    downloads each of image_sizes of a film's poster into directory
+    returns the poster path and a dict of file type: file name (None if the film has no poster)
+    """
+
+    with app_context(app):
+        if not poster_path:
+            poster_path = get_movie_data(tmdb_id).get("poster_path")
+        if not poster_path:
+            return None
+
+        names = {}
+        for type_, size in image_sizes:
+            names[type_] = type_ + os.path.splitext(poster_path)[1]
+            download_image(poster_path, os.path.join(directory, names[type_]), size=size)
+
+        return poster_path, names
+
+
+def store_images(movies, poster_path, names):
+    """links the downloaded images (file type: file name) to every copy of a film"""
+
+    for type_, name in names.items():
+        file, replaced = File(name, type_), set()
+        for movie in movies:
+            replaced.update(existing for existing in movie.files if existing.type == type_)
+            movie.files = [existing for existing in movie.files if existing.type != type_] + [file]
+
+        for existing in replaced:
+            session.delete(existing)
+
+    for movie in movies:
+        movie.poster_path = poster_path
+
+
+if __name__ == '__main__':
+    init_headless()
+    check_dirs()
+    download_movie_images(workers=setting("IMAGE_WORKERS"))
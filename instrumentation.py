@@ -0,0 +1,59 @@
+"""
+instrumentation hooks (used by tests and for debugging) - e.g. counting the sql statements a request executes
+"""
+import threading
+from contextlib import contextmanager
+
+from flask import g
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_local = threading.local()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def record_statement(conn, cursor, statement, parameters, context, executemany):
+    for statements in getattr(_local, "recorders", ()):
+        statements.append(statement)
+
+
+@contextmanager
+def count_queries():
+    """
+    records the sql statements executed by the current thread within the block, e.g.
+
+    with count_queries() as statements:
+        client.post("/movies")
+    assert len(statements) == 4
+    """
+
+    if not hasattr(_local, "recorders"):
+        _local.recorders = []
+
+    statements = []
+    _local.recorders.append(statements)
+    try:
+        yield statements
+    finally:
+        _local.recorders.remove(statements)
+
+
+def init_query_count_header(app):
+    """adds an X-Query-Count header (the number of sql statements executed) to every response of app"""
+
+    @app.before_request
+    def start_counting():
+        g.query_counter = count_queries()
+        g.statements = g.query_counter.__enter__()
+
+    @app.after_request
+    def add_query_count(response):
+        if "query_counter" in g:
+            response.headers["X-Query-Count"] = str(len(g.statements))
+        return response
+
+    # (after_request is skipped when a request fails, teardown_request never is)
+    @app.teardown_request
+    def stop_counting(exception):
+        if "query_counter" in g:
+            g.pop("query_counter").__exit__(None, None, None)
@@ -0,0 +1,173 @@
+"""
+background scan jobs - walking and parsing the sources runs on a bounded pool of threads rather than in the request that
+asked for it, which only gets a job id back to poll for progress and page through the results once the job finishes
+"""
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+from metrics import StageTimer
+from scanner import scan_sources
+from utils import iter_files, process_files, flatten_movie_results, files_as_dicts
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueueFull(Exception):
+    """raised when a job is submitted while max_pending jobs are already queued or running"""
+
+
+class ScanJob:
+    """a scan of addresses, its status (queued, running, finished or failed), progress and (once finished) results"""
+
+    def __init__(self, addresses):
+        self.id = uuid.uuid4().hex
+        self.addresses = addresses
+
+        self.status = "queued"
+        self.stage = None
+        self.sources_scanned = 0
+        self.files = 0
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+
+        self.movies = None  # movie dicts sorted by title
+        self.raw_data = None
+        self.errors = None  # address: error message of the sources that couldn't be scanned
+
+    @property
+    def done(self):
+        return self.status in ("finished", "failed")
+
+    def run(self, workers=4, timeout=None, parse_workers=1):
+        self.status, self.started_at = "running", time.time()
+
+        timer = StageTimer()
+        try:
+            self.stage = "walking"
+            with timer.stage("walk"):
+                files, errors = scan_sources(self.addresses, workers=workers, timeout=timeout, progress=self._scanned)
+
+            self.stage = "parsing"
+            self.files = sum(1 for _ in iter_files(files))
+            with timer.stage("parse"):
+                process_files(files, workers=parse_workers)
+
+            self.stage = "collecting"
+            with timer.stage("flatten"):
+                movies = sorted(flatten_movie_results(files) or [], key=lambda movie: movie.title)
+
+            self.movies = [movie.as_dict() for movie in movies]
+            self.raw_data = files_as_dicts(files)
+            self.errors = {address: str(error) for address, error in errors.items()}
+            self.status = "finished"
+
+            timer.observe("job")
+        except Exception as e:
+            logger.exception("scan job %s failed", self.id)
+            self.status, self.error = "failed", str(e)
+        finally:
+            self.stage, self.finished_at = None, time.time()
+
+    def _scanned(self, address, error):
+        self.sources_scanned += 1
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "progress": {
+                "stage": self.stage,
+                "sources_scanned": self.sources_scanned,
+                "sources_total": len(self.addresses),
+                "files": self.files,
+            },
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+            "movie_count": len(self.movies) if self.movies is not None else None,
+        }
+
+
+class ScanJobs:
+    """
+    registry of scan jobs run on workers threads, at most max_pending jobs are queued or running at once and the kept
+    most recently finished jobs are kept (with their results)
+
+    safe to share between threads
+    """
+
+    def __init__(self, workers=1, max_pending=4, kept=10):
+        self.max_pending = max_pending
+        self.kept = kept
+
+        self.jobs = OrderedDict()  # job id: job, oldest first
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scan_job")
+        self._lock = threading.Lock()
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def latest(self):
+        """the most recently submitted job (None if there are none)"""
+
+        with self._lock:
+            return next(reversed(self.jobs.values()), None)
+
+    def submit(self, addresses, **kwargs):
+        """
+        starts a scan job of addresses (kwargs are passed to ScanJob.run) and returns it, or the job already scanning
+        the same addresses if there is one
+        raises JobQueueFull if max_pending jobs are already queued or running
+        """
+
+        addresses = list(dict.fromkeys(addresses))
+
+        with self._lock:
+            pending = [job for job in self.jobs.values() if not job.done]
+            for job in pending:
+                if job.addresses == addresses:
+                    return job
+
+            if len(pending) >= self.max_pending:
+                raise JobQueueFull(f"{len(pending)} scan jobs are already pending")
+
+            job = ScanJob(addresses)
+            self.jobs[job.id] = job
+            self._prune()
+
+        self._executor.submit(job.run, **kwargs)
+
+        return job
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.done]
+        for job_id in finished[:max(0, len(finished) - self.kept)]:
+            del self.jobs[job_id]
+
+
+scan_jobs = None
+scan_jobs_lock = threading.Lock()
+
+
+def get_scan_jobs():
+    """the process's scan job registry, sized by the SCAN_JOB_* settings of the app that first uses it"""
+
+    global scan_jobs
+
+    with scan_jobs_lock:
+        if scan_jobs is None:
+            scan_jobs = ScanJobs(workers=current_app.config["SCAN_JOB_WORKERS"],
+                                 max_pending=current_app.config["SCAN_JOB_MAX_PENDING"],
+                                 kept=current_app.config["SCAN_JOBS_KEPT"])
+
+        return scan_jobs
@@ -0,0 +1,196 @@
+"""
+queries backing the movie listing api - filtered, sorted and paginated with keyset (cursor) pagination so that every
+page costs the same no matter how deep into the library it is
+"""
+import base64
+import datetime
+import json
+
+from sqlalchemy.orm import selectinload
+
+from models import Movie
+
+# sort key: (column, descending by default)
+sort_keys = {
+    "vote_average": (Movie.vote_average, True),
+    "popularity": (Movie.popularity, True),
+    "title": (Movie.title, False),
+    "release_date": (Movie.release_date, True),
+    "created_at": (Movie.created_at, True),
+}
+
+# sort key: the json types its cursor values can have (datetimes are encoded as iso format strings)
+cursor_value_types = {
+    "vote_average": (int, float),
+    "popularity": (int, float),
+    "title": str,
+    "release_date": str,
+    "created_at": str,
+}
+
+default_limit = 100
+max_limit = 500
+
+
+def list_movies(params):
+    """
+    returns a page of movies (and the cursor of the next page, None when there are no more pages) for params, a mapping
+    of request parameters:
+
+    sort - one of sort_keys (default vote_average) and order - asc or desc
+    limit - page size (up to max_limit) and cursor - as returned for the previous page
+    year_min/year_max - release year range, resolution, source, codec - marked values and tmdb_matched - true or false
+
+    raises ValueError for invalid parameters
+    """
+
+    column, descending = sort_order(params)
+    limit = page_limit(params)
+
+    # files (for the image path) are loaded with one extra query per page rather than one per movie
+    query = filter_movies(Movie.query.options(selectinload(Movie.files)), params)
+    if descending:
+        query = query.order_by(column.desc(), Movie.id.desc())
+    else:
+        query = query.order_by(column.asc(), Movie.id.asc())
+
+    segments = [None]
+    if params.get("cursor"):
+        value, last_id = decode_cursor(params["cursor"], column)
+        segments = after(column, value, last_id, descending)
+
+    movies = []
+    for condition in segments:
+        segment_query = query.filter(condition) if condition is not None else query
+        movies += segment_query.limit(limit + 1 - len(movies)).all()
+        if len(movies) > limit:
+            break
+
+    next_cursor = None
+    if len(movies) > limit:
+        movies = movies[:limit]
+        next_cursor = encode_cursor(getattr(movies[-1], column.key), movies[-1].id)
+
+    return movies, next_cursor
+
+
+def validate_params(params):
+    """raises ValueError if params (see list_movies) are invalid, without querying the database"""
+
+    column, _ = sort_order(params)
+    page_limit(params)
+    filter_movies(Movie.query, params)
+
+    if params.get("cursor"):
+        decode_cursor(params["cursor"], column)
+
+
+def sort_order(params):
+    """the column to sort by and whether it is descending"""
+
+    sort = params.get("sort", "vote_average")
+    if sort not in sort_keys:
+        raise ValueError(f"invalid sort {sort!r}")
+
+    column, descending = sort_keys[sort]
+    if params.get("order"):
+        if params["order"] not in ("asc", "desc"):
+            raise ValueError(f"invalid order {params['order']!r}")
+        descending = params["order"] == "desc"
+
+    return column, descending
+
+
+def page_limit(params):
+    limit = min(parse_int(params, "limit", default_limit), max_limit)
+    if limit < 1:
+        raise ValueError("limit must be positive")
+
+    return limit
+
+
+def filter_movies(query, params):
+    """applies the (optional) filters in params to query"""
+
+    year_min, year_max = parse_int(params, "year_min"), parse_int(params, "year_max")
+    if year_min is not None:
+        query = query.filter(Movie.release_date >= datetime.datetime(year_min, 1, 1))
+    if year_max is not None:
+        query = query.filter(Movie.release_date < datetime.datetime(year_max + 1, 1, 1))
+
+    for attribute in ["resolution", "source", "codec"]:
+        if params.get(attribute):
+            query = query.filter(getattr(Movie, "_marked_" + attribute) == params[attribute])
+
+    if params.get("tmdb_matched"):
+        if params["tmdb_matched"] not in ("true", "false"):
+            raise ValueError(f"invalid tmdb_matched {params['tmdb_matched']!r}")
+        query = query.filter(Movie.tmdb_matched == (params["tmdb_matched"] == "true"))
+
+    return query
+
+
+def after(column, value, last_id, descending):
+    """
+    the conditions selecting rows that come after (value, last_id) when ordered by column then id
+
+    they are split into segments to be read in turn, each of which is a range of column's index (as a single condition
+    the database would scan the index from the start), nulls sort first in sqlite so they are a segment of their own at
+    the end of descending orders and the start of ascending ones
+    """
+
+    if descending:
+        if value is None:
+            return [(column == None) & (Movie.id < last_id)]
+        return [(column <= value) & ((column < value) | (Movie.id < last_id)), column == None]
+
+    if value is None:
+        return [(column == None) & (Movie.id > last_id), column != None]
+    return [(column >= value) & ((column > value) | (Movie.id > last_id))]
+
+
+def encode_cursor(value, last_id):
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+
+    return base64.urlsafe_b64encode(json.dumps([value, last_id]).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor, column):
+    try:
+        value, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        # a cursor from another sort can't be compared against this one's values
+        if value is not None and not isinstance(value, cursor_value_types[column.key]):
+            raise ValueError
+        if value is not None and column.key in ("release_date", "created_at"):
+            value = datetime.datetime.fromisoformat(value)
+        last_id = int(last_id)
+    except (ValueError, TypeError):
+        raise ValueError("invalid cursor")
+
+    return value, last_id
+
+
+def parse_int(params, name, default=None):
+    if not params.get(name):
+        return default
+
+    try:
+        return int(params[name])
+    except ValueError:
+        raise ValueError(f"invalid {name} {params[name]!r}")
+
+
+def serialize_movie(movie):
+    """listing representation of a movie"""
+
+    return {
+        "id": movie.id,
+        "img_path": movie.img_path,
+        "title": movie.title,
+        "overview": movie.overview,
+        "year": movie.release_year,
+        "runtime": movie.runtime,
+        "vote_average": movie.vote_average,
+        "vote_count": movie.vote_count,
+    }
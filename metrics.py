@@ -0,0 +1,239 @@
+"""
+built in metrics - request, scan stage, sql statement and TMDB request timings kept in memory and exposed as prometheus
+text at /metrics, plus optional per request profiling
+
+nothing is recorded (and no hooks are installed) unless init_metrics enables it, so disabled metrics cost one check of
+a module flag where they are recorded
+"""
+import bisect
+import cProfile
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from flask import current_app, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# whether metrics are recorded, set by init_metrics
+enabled = False
+
+default_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+sql_buckets = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0]
+scan_buckets = [0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0]
+
+# histograms in the order they are exposed
+registry = []
+
+
+class Histogram:
+    """
+    prometheus histogram (cumulative bucket counts, sum and count) of observations for each combination of its labels
+
+    safe to share between threads
+    """
+
+    def __init__(self, name, description, labels=(), buckets=default_buckets):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+
+        self._series = {}  # label values: [count per bucket (the last is +Inf), sum]
+        self._lock = threading.Lock()
+
+        registry.append(self)
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self):
+        with self._lock:
+            series = sorted((label_values, list(counts), total)
+                            for label_values, (counts, total) in self._series.items())
+
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for label_values, counts, total in series:
+            labels = [f'{name}="{escape(value)}"' for name, value in zip(self.labels, label_values)]
+
+            cumulative = 0
+            for bound, count in zip([*self.buckets, "+Inf"], counts):
+                cumulative += count
+                bucket_labels = ",".join([*labels, f'le="{bound}"'])
+                lines.append(f"{self.name}_bucket{{{bucket_labels}}} {cumulative}")
+
+            label_string = "{" + ",".join(labels) + "}" if labels else ""
+            lines.append(f"{self.name}_sum{label_string} {total}")
+            lines.append(f"{self.name}_count{label_string} {cumulative}")
+
+        return "\n".join(lines)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+request_duration = Histogram("http_request_duration_seconds", "time taken to handle requests",
+                             ["endpoint", "method", "status"])
+scan_stage_duration = Histogram("scan_stage_duration_seconds", "time spent in each stage of a scan", ["scan", "stage"],
+                                buckets=scan_buckets)
+sql_duration = Histogram("sql_statement_duration_seconds", "time taken to execute sql statements", ["operation"],
+                         buckets=sql_buckets)
+tmdb_duration = Histogram("tmdb_request_duration_seconds", "time taken by requests to TMDB (each attempt)",
+                          ["endpoint", "status"])
+
+
+def render():
+    """every metric as prometheus text"""
+
+    return "\n".join(histogram.render() for histogram in registry) + "\n"
+
+
+class StageTimer:
+    """
+    times the stages of a streaming pipeline (where stages are interleaved), the time spent pulling an item from a
+    stage's iterable is attributed to that stage less the time spent in the stages it pulls from in turn
+
+    with timer.stage("upsert"):
+        store(timer.iterate("parse", parse(timer.iterate("walk", walk()))))
+    timer.observe("full")
+    """
+
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.current = None
+
+    @contextmanager
+    def stage(self, stage):
+        parent, self.current = self.current, stage
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._attribute(stage, parent, time.perf_counter() - start)
+
+    def iterate(self, stage, iterable):
+        if not enabled:
+            return iterable
+
+        return self._iterate(stage, iter(iterable))
+
+    def _iterate(self, stage, iterator):
+        while True:
+            parent, self.current = self.current, stage
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._attribute(stage, parent, time.perf_counter() - start)
+
+            yield item
+
+    def _attribute(self, stage, parent, elapsed):
+        self.current = parent
+        self.totals[stage] += elapsed
+        if parent is not None:
+            self.totals[parent] -= elapsed
+
+    def observe(self, scan):
+        """records the time spent in each stage as a scan of type scan"""
+
+        if not enabled:
+            return
+
+        for stage, total in self.totals.items():
+            scan_stage_duration.observe(max(0.0, total), scan, stage)
+
+
+def observe_tmdb_request(endpoint, status, elapsed):
+    if enabled:
+        tmdb_duration.observe(elapsed, endpoint, status)
+
+
+sql_operations = {"SELECT", "INSERT", "UPDATE", "DELETE"}
+
+
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_start_times", []).append(time.perf_counter())
+
+
+def end_statement(conn, cursor, statement, parameters, context, executemany):
+    start_times = conn.info.get("metrics_start_times")
+    if not start_times:
+        return
+
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+    sql_duration.observe(time.perf_counter() - start_times.pop(), operation if operation in sql_operations else "OTHER")
+
+
+def discard_statement(exception_context):
+    # after_cursor_execute isn't called for statements that fail
+    connection = exception_context.connection
+    if connection is not None and connection.info.get("metrics_start_times"):
+        connection.info["metrics_start_times"].pop()
+
+
+def init_metrics(app):
+    """
+    records metrics for app (and every sql statement executed by the process) and exposes them at /metrics, and
+    profiles requests as configured by PROFILE and PROFILE_HEADER
+    """
+
+    global enabled
+
+    if not event.contains(Engine, "before_cursor_execute", start_statement):
+        event.listen(Engine, "before_cursor_execute", start_statement)
+        event.listen(Engine, "after_cursor_execute", end_statement)
+        event.listen(Engine, "handle_error", discard_statement)
+
+    enabled = True
+
+    @app.before_request
+    def start_request():
+        g.metrics_start = time.perf_counter()
+
+        if app.config["PROFILE"] or (app.config["PROFILE_HEADER"] and request.headers.get("X-Profile")):
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    @app.after_request
+    def end_request(response):
+        if "profiler" in g:
+            g.profiler.disable()
+            response.headers["X-Profile"] = save_profile(g.pop("profiler"))
+
+        if "metrics_start" in g:
+            request_duration.observe(time.perf_counter() - g.metrics_start, request.endpoint or "none", request.method,
+                                     str(response.status_code))
+        return response
+
+    app.add_url_rule("/metrics", "metrics", lambda: current_app.response_class(
+        render(), mimetype="text/plain; version=0.0.4"))
+
+
+def save_profile(profiler):
+    """saves the profile of the current request to PROFILE_DIR, returns its file name"""
+
+    directory = os.path.join(current_app.root_path, current_app.config["PROFILE_DIR"])
+    os.makedirs(directory, exist_ok=True)
+
+    endpoint = re.sub(r"[^\w.-]", "_", request.endpoint or "none")
+    name = f"{endpoint}-{time.time():.6f}.prof"
+    profiler.dump_stats(os.path.join(directory, name))
+
+    return name
@@ -2,9 +2,12 @@ import datetime
 import hashlib
 import os
 
+from sqlalchemy import event
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import Session
 
 from app import db
+from headless import current_session
 
 
 class Source(db.Model):
@@ -21,29 +24,54 @@ class Source(db.Model):
         return f"<Source {self.id}>"
 
 
+class Directory(db.Model):
+    """filesystem state of a scanned directory, used to skip unchanged directories when scanning incrementally"""
+    __tablename__ = "directories"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    path = db.Column(db.String(2048), unique=True)
+    parent_path = db.Column(db.String(2048), index=True)
+    mtime = db.Column(db.BigInteger)
+
+    def __init__(self, path, parent_path, mtime):
+        self.path = path
+        self.parent_path = parent_path
+        self.mtime = mtime
+
+    def __repr__(self):
+        return f"<Directory {self.path}>"
+
+
 class Movie(db.Model):
     __tablename__ = "movies"
+    __table_args__ = (
+        db.Index("ix_movies_path_filename", "path", "filename"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
-    created_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, index=True)
 
     filename = db.Column(db.String(256))
     path = db.Column(db.String(2048))
 
+    # filesystem state at the time of the last scan, used to detect changed files
+    file_size = db.Column(db.BigInteger)
+    file_mtime = db.Column(db.BigInteger)
+
     # marked means that the data has been inferred from the filename
-    _marked_codec = db.Column(db.String(16))
+    _marked_codec = db.Column(db.String(16), index=True)
     _marked_edition = db.Column(db.String(32))
-    _marked_resolution = db.Column(db.String(8))
+    _marked_resolution = db.Column(db.String(8), index=True)
     _marked_sample = db.Column(db.Boolean)
-    _marked_source = db.Column(db.String(8))
+    _marked_source = db.Column(db.String(8), index=True)
     _marked_title = db.Column(db.String(256))
     _marked_year = db.Column(db.String(4))
 
     def set_marked_attr(self, attribute, value):
         setattr(self, attribute, value)
-        self.generate_hash()
 
-    # marked attributes setting is intercepted to update object hash
+    # the object hash isn't updated on every set, it is computed once per flush (see update_obj_hash)
     marked_codec = hybrid_property(fget=lambda self: self._marked_codec,
                                    fset=lambda self, val: self.set_marked_attr("_marked_codec", val))
     marked_edition = hybrid_property(fget=lambda self: self._marked_edition,
@@ -59,24 +87,26 @@ class Movie(db.Model):
     marked_year = hybrid_property(fget=lambda self: self._marked_year,
                                   fset=lambda self, val: self.set_marked_attr("_marked_year", val))
 
-    obj_hash = db.Column(db.Integer)
+    # fingerprint of the scanned state (see compute_hash), used to detect changed files
+    obj_hash = db.Column(db.BigInteger, index=True)
 
     # tmdb data
-    tmdb_id = db.Column(db.Integer)
+    tmdb_id = db.Column(db.Integer, index=True)
     tmdb_last_checked = db.Column(db.DateTime)
     imdb_id = db.Column(db.String(10))
-    title = db.Column(db.String(128))
+    title = db.Column(db.String(128), index=True)
     original_title = db.Column(db.String(128))
     overview = db.Column(db.String(1024))
     adult = db.Column(db.Boolean)
-    popularity = db.Column(db.Float)
-    release_date = db.Column(db.DateTime)
+    popularity = db.Column(db.Float, index=True)
+    release_date = db.Column(db.DateTime, index=True)
     revenue = db.Column(db.Integer)
     runtime = db.Column(db.Integer)
     status = db.Column(db.String(16))
     tagline = db.Column(db.String(512))
-    vote_average = db.Column(db.Integer)
+    vote_average = db.Column(db.Integer, index=True)
     vote_count = db.Column(db.Integer)
+    poster_path = db.Column(db.String(64))
 
     files = db.relationship("File", secondary="movie_files")
 
@@ -95,8 +125,6 @@ class Movie(db.Model):
         self.marked_title = marked_title
         self.marked_year = marked_year
 
-        self.generate_hash()
-
     def __repr__(self):
         return f"<Movie {self.id}>"
 
@@ -119,13 +147,22 @@ class Movie(db.Model):
         self.overview = response["overview"]
         self.adult = True if response["adult"] == "True" else False
         self.popularity = response["popularity"]
-        self.release_date = datetime.datetime.strptime(response["release_date"], "%Y-%m-%d")
+        self.release_date = datetime.datetime.strptime(response["release_date"], "%Y-%m-%d") \
+            if response["release_date"] else None
         self.revenue = response["revenue"]
         self.runtime = response["runtime"]
         self.status = response["status"]
         self.tagline = response["tagline"]
         self.vote_average = response["vote_average"]
         self.vote_count = response["vote_count"]
+        self.poster_path = response.get("poster_path")
+
+    def copy_tmdb_general(self, movie):
+        """copies the tmdb data of movie (another copy of the same film) rather than looking it up again"""
+
+        self.tmdb_last_checked = datetime.datetime.now()
+        for column in tmdb_general_columns:
+            setattr(self, column, getattr(movie, column))
 
     @hybrid_property
     def tmdb_matched(self):
@@ -162,6 +199,21 @@ class Movie(db.Model):
         """movies are stored in directories based on tmdb id"""
         return os.path.join(self.web_parent_path, str(self.tmdb_id))
 
+    def get_file(self, type_):
+        return next((file for file in self.files if file.type == type_), None)
+
+    @property
+    def img_path(self):
+        """web path of the movie's image (relative to static), thumbnails are preferred as they are much smaller"""
+        file = self.get_file("thumb") or (self.files[0] if self.files else None)
+        return os.path.join(self.web_path, file.name) if file else "#"
+
+    @property
+    def poster_img_path(self):
+        """web path of the movie's full size poster (relative to static)"""
+        file = self.get_file("poster") or (self.files[0] if self.files else None)
+        return os.path.join(self.web_path, file.name) if file else "#"
+
     @property
     def movie_path(self):
         return os.path.join(self.path, self.filename)
@@ -177,13 +229,29 @@ class Movie(db.Model):
             os.mkdir(self.dir)
 
 
+# columns set by Movie.update_tmdb_general (other than tmdb_last_checked)
+tmdb_general_columns = ["tmdb_id", "imdb_id", "title", "original_title", "overview", "adult", "popularity",
+                        "release_date", "revenue", "runtime", "status", "tagline", "vote_average", "vote_count",
+                        "poster_path"]
+
+
 def compute_hash(*args):
-    string = ""
+    """
+    64 bit (signed, to fit an sqlite integer) blake2b fingerprint of args, empty values (None, "", False) are treated
+    as the same and args are separated so that moving characters from one to the next changes the fingerprint
+    """
+
+    string = "\x1f".join(str(arg) if arg else "" for arg in args)
+
+    return int.from_bytes(hashlib.blake2b(string.encode('utf-8'), digest_size=8).digest(), "big", signed=True)
+
 
-    for arg in args:
-        string += str(arg) if arg else "None"
+@event.listens_for(Movie, "before_insert")
+@event.listens_for(Movie, "before_update")
+def update_obj_hash(mapper, connection, movie):
+    """computes the object hash once as a movie is written (however many of its attributes were set)"""
 
-    return hashlib.md5(string.encode('utf-8')).hexdigest()
+    movie.generate_hash()
 
 
 class File(db.Model):
@@ -209,3 +277,90 @@ class MovieFile(db.Model):
 
     movie_id = db.Column(db.Integer, db.ForeignKey("movies.id"), primary_key=True)
     file_id = db.Column(db.Integer, db.ForeignKey("files.id"), primary_key=True)
+
+
+class TitleMatch(db.Model):
+    """
+    the TMDB movie a (normalized) marked title and year resolved to - tmdb_id is None if nothing matched - so that new
+    copies of a known film are matched without looking them up again
+    """
+    __tablename__ = "title_matches"
+
+    title = db.Column(db.String(256), primary_key=True)
+    year = db.Column(db.String(4), primary_key=True)  # empty if the title had no year
+    tmdb_id = db.Column(db.Integer)
+    checked_at = db.Column(db.DateTime)
+
+    def __init__(self, title, year, tmdb_id, checked_at):
+        self.title = title
+        self.year = year
+        self.tmdb_id = tmdb_id
+        self.checked_at = checked_at
+
+    def __repr__(self):
+        return f"<TitleMatch {self.title} ({self.year})>"
+
+
+class LibraryVersion(db.Model):
+    """
+    single row counter incremented whenever the library (movies, their files or sources) changes, used to tell clients
+    whether their cached copy of a response is still current
+    """
+    __tablename__ = "library_version"
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+    updated_at = db.Column(db.DateTime)
+
+
+class LibraryChange(db.Model):
+    """the movies changed (added, updated or removed) by each library version, the most recent versions are kept"""
+    __tablename__ = "library_changes"
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, index=True)
+    movie_id = db.Column(db.Integer, nullable=False)
+
+
+# number of versions library changes are kept for (anything that is further behind has to be rebuilt from scratch)
+library_changes_kept = 1000
+
+
+def bump_library_version(movie_ids=(), session=None):
+    """increments the library version recording the ids of the movies changed (as part of the current transaction)"""
+
+    session = session or current_session()
+    table, now = LibraryVersion.__table__, datetime.datetime.utcnow().replace(microsecond=0)
+
+    result = session.execute(table.update().where(table.c.id == 1).values(version=table.c.version + 1, updated_at=now))
+    if not result.rowcount:
+        session.execute(table.insert().values(id=1, version=1, updated_at=now))
+
+    version = session.execute(db.select([table.c.version]).where(table.c.id == 1)).scalar()
+
+    changes = LibraryChange.__table__
+    if movie_ids:
+        session.execute(changes.insert(), [{"version": version, "movie_id": movie_id} for movie_id in set(movie_ids)])
+    session.execute(changes.delete().where(changes.c.version <= version - library_changes_kept))
+
+
+def get_library_version():
+    """returns the current library version and when it was last changed"""
+
+    row = current_session().query(LibraryVersion.version, LibraryVersion.updated_at).filter_by(id=1).first()
+    return (row.version, row.updated_at) if row else (0, None)
+
+
+@event.listens_for(Session, "after_flush")
+def track_library_changes(session, flush_context):
+    """bumps the library version whenever a flush changes the library (bulk core statements need to bump it directly)"""
+
+    library_models = (Movie, File, Source)
+
+    changed = [instance for instance in session.new if isinstance(instance, library_models)]
+    changed += [instance for instance in session.deleted if isinstance(instance, library_models)]
+    changed += [instance for instance in session.dirty
+                if isinstance(instance, library_models) and session.is_modified(instance)]
+
+    if changed:
+        bump_library_version([instance.id for instance in changed if isinstance(instance, Movie)], session=session)
@@ -0,0 +1,100 @@
+"""
+cache of filename parsing results with least recently used eviction, persisted (as a pickle) between scans
+"""
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class ParseCache:
+    """
+    caches the result of parsing each name, keeping the max_entries most recently used
+
+    entries are saved along with the version of the parser that produced them and only loaded by the same version, so
+    changing the parser invalidates them
+    safe to share between threads
+    """
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, name):
+        """returns the result stored for name (None if there isn't one)"""
+
+        with self._lock:
+            result = self._entries.get(name)
+            if result is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(name)
+            self.hits += 1
+
+            return result
+
+    def set(self, name, result):
+        with self._lock:
+            self._entries[name] = result
+            self._entries.move_to_end(name)
+            self.sets += 1
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def load(self, path, version):
+        """adds the entries saved at path (if any) by the same parser version, returns the number loaded"""
+
+        try:
+            with open(path, "rb") as cache_file:
+                saved_version, entries = pickle.load(cache_file)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            return 0
+
+        if saved_version != version:
+            return 0
+
+        # saved least recently used first, so entries already in memory are kept as the most recently used
+        with self._lock:
+            loaded = OrderedDict(entries[-self.max_entries:])
+            for name in self._entries:
+                loaded.pop(name, None)
+            loaded.update(self._entries)
+            self._entries = loaded
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return len(entries)
+
+    def save(self, path, version):
+        with self._lock:
+            entries = list(self._entries.items())
+
+        # written to a temporary file that is then renamed so the cache on disk is never partially written
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(path)), suffix=".part",
+                                         delete=False) as cache_file:
+            pickle.dump((version, entries), cache_file, pickle.HIGHEST_PROTOCOL)
+
+        os.replace(cache_file.name, path)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
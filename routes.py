@@ -1,10 +1,14 @@
-import os
+from flask import abort, current_app, jsonify, render_template, redirect, url_for, request, Blueprint
 
-from flask import jsonify, render_template, redirect, url_for, request, Blueprint
+from sqlalchemy.orm import joinedload
 
 from app import db
+from http_cache import cached_json
+from jobs import JobQueueFull, get_scan_jobs
+from listing import list_movies, filter_movies, serialize_movie, validate_params, page_limit, parse_int
 from models import Source, Movie
-from utils import get_directory_structure, process_files, flatten_movie_results
+from search import search_movies
+from snapshot import get_snapshot, serves
 
 bp = Blueprint('movies', __name__, url_prefix="/")
 
@@ -19,37 +23,90 @@ def movies():
     if request.method == "GET":
         return render_template("movies.html")
 
-    num_sources = Source.query.count()
-    movies_dict = [
-        {
-            "id": movie.id,
-            "img_path": os.path.join(movie.web_path, movie.files[0].name) if movie.files else "#",
-            "title": movie.title,
-            "overview": movie.overview,
-            "year": movie.release_year,
-            "runtime": movie.runtime,
-            "vote_average": movie.vote_average,
-            "vote_count": movie.vote_count,
-        }
-        for movie in Movie.query.order_by(Movie.vote_average.desc()).all()
-    ]
+    try:
+        return json_response(movies_payload(request.values)), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+
+@bp.route("/api/movies")
+def api_movies():
+    try:
+        # parameters are validated up front as the payload is only built if the client's copy is stale
+        validate_params(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return cached_json(request.full_path, lambda: movies_payload(request.args))
+
+
+def json_response(payload):
+    """a json response of payload, which may already be serialized"""
+
+    if isinstance(payload, str):
+        return current_app.response_class(payload, mimetype="application/json")
+    return jsonify(payload)
 
-    return jsonify({
-        "movies": movies_dict,
-        "movie_count": len(movies_dict),
-        "source_count": num_sources,
-    }), 200
+
+def movies_payload(params):
+    # unfiltered listings (the library grid) are served from the snapshot without querying the movies
+    if serves(params):
+        return get_snapshot().payload(params)
+
+    movies_page, next_cursor = list_movies(params)
+
+    payload = {
+        "movies": [serialize_movie(movie) for movie in movies_page],
+        "next_cursor": next_cursor,
+    }
+
+    # totals are only needed (and only counted) for the first page
+    if not params.get("cursor"):
+        payload["movie_count"] = filter_movies(Movie.query, params).count()
+        payload["source_count"] = Source.query.count()
+
+    return payload
+
+
+@bp.route("/api/search")
+def api_search():
+    try:
+        return cached_json(request.full_path, lambda: search_payload(request.args))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+
+def search_payload(params):
+    movies_page, next_offset = search_movies(params)
+
+    # the offset is returned as the cursor so that search results page like the listing
+    return {
+        "movies": [serialize_movie(movie) for movie in movies_page],
+        "next_cursor": str(next_offset) if next_offset is not None else None,
+    }
 
 
 @bp.route("/movie/<movie_id>", methods=["POST"])
 def movie(movie_id):
-    movie = Movie.query.filter_by(id=movie_id).first_or_404()
+    return jsonify(movie_payload(movie_id)), 200
 
-    return jsonify({
+
+@bp.route("/api/movie/<movie_id>")
+def api_movie(movie_id):
+    if not db.session.query(Movie.query.filter_by(id=movie_id).exists()).scalar():
+        abort(404)
+
+    return cached_json(request.path, lambda: movie_payload(movie_id))
+
+
+def movie_payload(movie_id):
+    movie = Movie.query.options(joinedload(Movie.files)).filter_by(id=movie_id).first_or_404()
+
+    return {
         "id": movie.id,
         "filename": movie.filename,
         "path": movie.path,
-        "img_path": os.path.join(movie.web_path, movie.files[0].name) if movie.files else "#",
+        "img_path": movie.poster_img_path,
         "marked": {
             "title": movie.marked_title,
             "year": movie.marked_year,
@@ -75,7 +132,7 @@ def movie(movie_id):
             "tagline": movie.tagline,
             "vote_average": movie.vote_average,
             "vote_count": movie.vote_count}
-    }), 200
+    }
 
 
 @bp.route("sources")
@@ -108,20 +165,77 @@ def update_sources():
     return jsonify(), 200
 
 
-@bp.route('/local_movies')
+@bp.route('/local_movies', methods=["GET", "POST"])
 def local_movies():
+    # walking the sources (network shares especially) can take minutes, so posting starts a background job (getting
+    # returns the latest one) and the client polls the job for its progress and then pages through its results
+    if request.method == "GET":
+        job = get_scan_jobs().latest()
+        if job is None:
+            abort(404)
+
+        return jsonify(job.as_dict()), 200, {"Location": url_for("movies.scan_job", job_id=job.id)}
+
     sources = Source.query.all()
 
-    files = {}
-    for source in sources:
-        key = source.address[:source.address.rfind("\\")]
-        if key not in files:
-            files[key] = {}
+    try:
+        job = get_scan_jobs().submit([source.address for source in sources],
+                                     workers=current_app.config["SCAN_WORKERS"],
+                                     timeout=current_app.config["SCAN_TIMEOUT"],
+                                     parse_workers=current_app.config["PARSE_WORKERS"])
+    except JobQueueFull as e:
+        return jsonify({"error": str(e)}), 503
+
+    return jsonify(job.as_dict()), 202, {"Location": url_for("movies.scan_job", job_id=job.id)}
+
+
+@bp.route("/scan_jobs/<job_id>")
+def scan_job(job_id):
+    return jsonify(get_scan_job(job_id).as_dict()), 200
+
+
+@bp.route("/scan_jobs/<job_id>/movies")
+def scan_job_movies(job_id):
+    job = get_finished_scan_job(job_id)
+
+    try:
+        limit = page_limit(request.args)
+        offset = parse_int(request.args, "offset", 0)
+        if offset < 0:
+            raise ValueError("offset must not be negative")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    next_offset = offset + limit if offset + limit < len(job.movies) else None
+
+    return jsonify({
+        "movies": job.movies[offset:offset + limit],
+        "next_cursor": str(next_offset) if next_offset is not None else None,
+        "movie_count": len(job.movies),
+        "errors": job.errors,
+    }), 200
+
+
+@bp.route("/scan_jobs/<job_id>/raw_data")
+def scan_job_raw_data(job_id):
+    return jsonify(get_finished_scan_job(job_id).raw_data), 200
+
+
+def get_scan_job(job_id):
+    job = get_scan_jobs().get(job_id)
+    if job is None:
+        abort(404)
+
+    return job
 
-        files[source.address[:source.address.rfind("\\")]].update(get_directory_structure(source.address))
 
-    process_files(files)
+def get_finished_scan_job(job_id):
+    """the job with job_id, aborting with a 409 (and the job's status) unless it has finished successfully"""
 
-    movie_list = sorted(flatten_movie_results(files), key=lambda key: key["marked"]["title"])
+    job = get_scan_job(job_id)
+    if job.status != "finished":
+        response = jsonify(job.as_dict())
+        response.status_code = 409
+        abort(response)
 
-    return jsonify({"movies": movie_list, "raw_data": files}), 200
+    return job
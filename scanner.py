@@ -0,0 +1,295 @@
+"""
+concurrent walking of sources - sources are usually separate shares/disks so walking them is I/O bound and can overlap
+"""
+import logging
+import math
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def source_key(address):
+    """the key a source's directory structure is stored under when merging several sources together"""
+
+    return os.path.dirname(address.rstrip(os.sep))
+
+
+def scan_directory_structure(root_directory, timeout=None):
+    """
+    os.scandir based equivalent of utils.get_directory_structure
+
+    raises TimeoutError if the walk takes longer than timeout seconds
+    """
+
+    root_directory = root_directory.rstrip(os.sep)
+    deadline = time.monotonic() + timeout if timeout is not None else None
+
+    return {root_directory[root_directory.rfind(os.sep) + 1:]: _scan(root_directory, deadline, root=True)}
+
+
+def _scan(path, deadline, root=False):
+    if deadline is not None and time.monotonic() > deadline:
+        raise TimeoutError(f"timed out scanning {path}")
+
+    directory = {}
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if not entry.is_dir():
+                    directory[entry.name] = None
+                elif not entry.is_symlink():  # like os.walk, symlinked directories aren't followed
+                    subdirectory = _scan(entry.path, deadline)
+                    if subdirectory is not None:
+                        directory[entry.name] = subdirectory
+    except OSError:
+        if root:
+            raise
+        return None  # like os.walk, unreadable subdirectories are skipped
+
+    return directory
+
+
+def scan_sources(addresses, workers=4, timeout=None, progress=None):
+    """
+    walks addresses concurrently and merges them into the nested structure expected by utils.process_files
+
+    timeout is applied per source, a source that fails or times out is logged and left out of the results rather than
+    stalling the whole scan
+    progress (if given) is called with the address and error (None if it succeeded) of each source as it finishes
+    returns the merged structure and a dict of address: error for the sources that failed
+    """
+
+    addresses = list(dict.fromkeys(addresses))
+    if not addresses:
+        return {}, {}
+
+    tasks, results = queue.Queue(), queue.Queue()
+    for address in addresses:
+        tasks.put(address)
+
+    workers = max(1, min(workers, len(addresses)))
+    for _ in range(workers):
+        # daemon threads so that a walk stuck on a dead mount can't keep the process alive
+        threading.Thread(target=_scan_worker, args=(tasks, results, timeout), daemon=True).start()
+
+    # every worker finishes a source within timeout unless it is stuck in a system call
+    deadline = time.monotonic() + timeout * math.ceil(len(addresses) / workers) if timeout is not None else None
+
+    structures, errors = {}, {}
+    while len(structures) + len(errors) < len(addresses):
+        try:
+            address, structure, error = results.get(
+                timeout=max(0.0, deadline - time.monotonic()) if deadline is not None else None)
+        except queue.Empty:
+            break
+
+        if error is not None:
+            errors[address] = error
+        else:
+            structures[address] = structure
+
+        if progress is not None:
+            progress(address, error)
+
+    for address in addresses:
+        if address not in structures and address not in errors:
+            errors[address] = TimeoutError(f"timed out scanning {address}")
+
+    for address, error in errors.items():
+        logger.warning("failed to scan source %s: %s", address, error)
+
+    files = {}
+    for address in addresses:
+        if address in structures:
+            files.setdefault(source_key(address), {}).update(structures[address])
+
+    return files, errors
+
+
+def _scan_worker(tasks, results, timeout):
+    while True:
+        try:
+            address = tasks.get_nowait()
+        except queue.Empty:
+            return
+
+        try:
+            results.put((address, scan_directory_structure(address, timeout=timeout), None))
+        except Exception as e:
+            results.put((address, None, e))
+
+
+def run_walks(addresses, walk, workers=4, timeout=None):
+    """
+    calls walk(address, deadline) for each of addresses on up to workers threads, where deadline is the time.monotonic()
+    by which the walk must finish (None without a timeout) or raise TimeoutError
+
+    as with scan_sources a walk that fails or times out is logged and left out of the results rather than stalling the
+    others, returns address: result of walk for the walks that finished
+    """
+
+    addresses = list(dict.fromkeys(addresses))
+    if not addresses:
+        return {}
+
+    tasks, results = queue.Queue(), queue.Queue()
+    for address in addresses:
+        tasks.put(address)
+
+    workers = max(1, min(workers, len(addresses)))
+    for _ in range(workers):
+        threading.Thread(target=_run_walk_worker, args=(tasks, results, walk, timeout), daemon=True).start()
+
+    deadline = time.monotonic() + timeout * math.ceil(len(addresses) / workers) if timeout is not None else None
+
+    walked, finished = {}, set()
+    while len(finished) < len(addresses):
+        try:
+            address, result, error = results.get(
+                timeout=max(0.0, deadline - time.monotonic()) if deadline is not None else None)
+        except queue.Empty:
+            break
+
+        finished.add(address)
+        if error is not None:
+            logger.warning("failed to scan source %s: %s", address, error)
+        else:
+            walked[address] = result
+
+    for address in addresses:
+        if address not in finished:
+            logger.warning("failed to scan source %s: timed out", address)
+
+    return walked
+
+
+def _run_walk_worker(tasks, results, walk, timeout):
+    while True:
+        try:
+            address = tasks.get_nowait()
+        except queue.Empty:
+            return
+
+        try:
+            results.put((address, walk(address, time.monotonic() + timeout if timeout is not None else None), None))
+        except Exception as e:
+            results.put((address, None, e))
+
+
+def walk_directories(root_directory):
+    """
+    yields (path, filenames) for root_directory and every directory below it, as they are listed
+
+    like os.walk, symlinked directories aren't followed and unreadable subdirectories are skipped (an unreadable
+    root_directory raises OSError)
+    """
+
+    stack = [root_directory.rstrip(os.sep)]
+    while stack:
+        path = stack.pop()
+
+        filenames, subdirectories = [], []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if not entry.is_dir():
+                        filenames.append(entry.name)
+                    elif not entry.is_symlink():
+                        subdirectories.append(entry.path)
+        except OSError:
+            if path == root_directory.rstrip(os.sep):
+                raise
+            continue
+
+        yield path, filenames
+        stack.extend(reversed(subdirectories))
+
+
+def iter_source_files(addresses, workers=4, timeout=None, errors=None, queue_size=1000):
+    """
+    walks addresses concurrently, yielding (path, filename) for every file as soon as its directory has been listed
+
+    at most queue_size directories are held waiting to be consumed so memory doesn't grow with the size of the sources
+    timeout is applied per source (time spent waiting on the consumer doesn't count), a source that fails or times out
+    is logged and recorded in errors (if given) as address: error
+    """
+
+    addresses = list(dict.fromkeys(addresses))
+    errors = errors if errors is not None else {}
+    if not addresses:
+        return
+
+    tasks, items, stop = queue.Queue(), queue.Queue(maxsize=queue_size), threading.Event()
+    for address in addresses:
+        tasks.put(address)
+
+    for _ in range(max(1, min(workers, len(addresses)))):
+        threading.Thread(target=_walk_worker, args=(tasks, items, stop, timeout), daemon=True).start()
+
+    finished = set()
+    try:
+        while len(finished) < len(addresses):
+            try:
+                # healthy walks keep producing directories, so silence this long means the remaining walks are stuck
+                item = items.get(timeout=timeout)
+            except queue.Empty:
+                break
+
+            if item[0] == "done":
+                _, address, error = item
+                finished.add(address)
+                if error is not None:
+                    errors[address] = error
+                    logger.warning("failed to scan source %s: %s", address, error)
+            else:
+                _, path, filenames = item
+                for filename in filenames:
+                    yield path, filename
+    finally:
+        stop.set()
+
+    for address in addresses:
+        if address not in finished:
+            errors[address] = TimeoutError(f"timed out scanning {address}")
+            logger.warning("failed to scan source %s: %s", address, errors[address])
+
+
+def _walk_worker(tasks, items, stop, timeout):
+    while not stop.is_set():
+        try:
+            address = tasks.get_nowait()
+        except queue.Empty:
+            return
+
+        error, elapsed = None, 0.0
+        try:
+            start = time.monotonic()
+            for path, filenames in walk_directories(address):
+                elapsed += time.monotonic() - start
+                if timeout is not None and elapsed > timeout:
+                    raise TimeoutError(f"timed out scanning {address}")
+
+                if not _put(items, ("directory", path, filenames), stop):
+                    return
+                start = time.monotonic()
+        except Exception as e:
+            error = e
+
+        if not _put(items, ("done", address, error), stop):
+            return
+
+
+def _put(items, item, stop):
+    """puts item on the (bounded) items queue unless stop is set first, returns whether it was put"""
+
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+
+    return False
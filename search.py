@@ -0,0 +1,106 @@
+"""
+full text search of the library - an sqlite fts5 index of the movies' titles, overviews and taglines that is kept in
+sync with the movies table by triggers
+"""
+import re
+
+from sqlalchemy import DDL, event, text
+from sqlalchemy.orm import selectinload
+
+from app import db
+from listing import page_limit, parse_int
+from models import Movie
+
+# indexed columns of the movies table and their weight when ranking matches
+search_columns = [("title", 10.0), ("original_title", 5.0), ("_marked_title", 5.0), ("tagline", 2.0), ("overview", 1.0)]
+
+columns = ", ".join(column for column, _ in search_columns)
+new_values = ", ".join("new." + column for column, _ in search_columns)
+old_values = ", ".join("old." + column for column, _ in search_columns)
+
+# an external content table (the text is only stored in movies), prefix indexes make short prefix queries fast
+search_ddl = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS movies_fts USING fts5({columns}, content='movies', content_rowid='id', "
+    f"tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    f"CREATE TRIGGER IF NOT EXISTS movies_fts_insert AFTER INSERT ON movies BEGIN "
+    f"INSERT INTO movies_fts (rowid, {columns}) VALUES (new.id, {new_values}); END",
+    f"CREATE TRIGGER IF NOT EXISTS movies_fts_delete AFTER DELETE ON movies BEGIN "
+    f"INSERT INTO movies_fts (movies_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values}); END",
+    # only updates of the indexed columns touch the index (not those of a rescan's file size and mtime)
+    f"CREATE TRIGGER IF NOT EXISTS movies_fts_update AFTER UPDATE OF {columns} ON movies BEGIN "
+    f"INSERT INTO movies_fts (movies_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values}); "
+    f"INSERT INTO movies_fts (rowid, {columns}) VALUES (new.id, {new_values}); END",
+]
+
+for statement in search_ddl:
+    event.listen(Movie.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+
+# engines whose database is known to have the search index
+indexed_engines = set()
+
+
+def ensure_search_index():
+    """creates the search index (and indexes the existing movies) if the database predates it"""
+
+    engine = db.get_engine()
+    if engine in indexed_engines:
+        return
+
+    with engine.begin() as connection:
+        exists = connection.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'movies_fts'")).scalar()
+        if not exists:
+            for statement in search_ddl:
+                connection.execute(text(statement))
+            connection.execute(text("INSERT INTO movies_fts (movies_fts) VALUES ('rebuild')"))
+
+    indexed_engines.add(engine)
+
+
+def match_query(query):
+    """
+    the fts5 query matching movies containing every word of query, the last word as a prefix (so results narrow as it is
+    typed), each word is quoted so that user input is never interpreted as query syntax
+    returns None if query has no words
+    """
+
+    words = re.findall(r"\w+", query)
+    if not words:
+        return None
+
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+
+    return " ".join(terms)
+
+
+def search_movies(params):
+    """
+    returns the page of movies (best match first) matching params["q"] and the offset of the next page (None when there
+    are no more matches), params also takes limit and offset
+    raises ValueError for invalid parameters
+    """
+
+    match = match_query(params.get("q", ""))
+    if match is None:
+        raise ValueError("missing search query")
+
+    limit = page_limit(params)
+    offset = parse_int(params, "offset", 0)
+    if offset < 0:
+        raise ValueError("offset must not be negative")
+
+    ensure_search_index()
+
+    weights = ", ".join(str(weight) for _, weight in search_columns)
+    movie_ids = [movie_id for movie_id, in db.session.execute(
+        text(f"SELECT rowid FROM movies_fts WHERE movies_fts MATCH :match ORDER BY bm25(movies_fts, {weights}) "
+             f"LIMIT :limit OFFSET :offset"),
+        {"match": match, "limit": limit + 1, "offset": offset})]
+
+    next_offset = offset + limit if len(movie_ids) > limit else None
+    movie_ids = movie_ids[:limit]
+
+    movies = {movie.id: movie for movie in Movie.query.options(selectinload(Movie.files)).filter(
+        Movie.id.in_(movie_ids))}
+
+    return [movies[movie_id] for movie_id in movie_ids if movie_id in movies], next_offset
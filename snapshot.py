@@ -0,0 +1,185 @@
+"""
+in memory (and optionally on disk) snapshot of the serialized library listing, kept up to date by re-reading only the
+movies changed since the library version it was built at rather than rebuilding it after every scan or enrichment
+"""
+import bisect
+import json
+import os
+import pickle
+import tempfile
+import threading
+
+from flask import current_app
+from sqlalchemy.orm import selectinload
+
+from app import db
+from listing import sort_keys, sort_order, page_limit, decode_cursor, encode_cursor, serialize_movie
+from models import Movie, Source, LibraryChange, get_library_version, library_changes_kept
+from utils import chunked
+
+# listing parameters that filter movies, listings using any of them are queried from the database instead
+filter_params = ["year_min", "year_max", "resolution", "source", "codec", "tmdb_matched"]
+
+
+class LibrarySnapshot:
+    """
+    every movie's listing json and sort values, with the order of each sort key built (and cached) when first needed
+
+    safe to share between threads
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+
+        self.version = None
+        self.source_count = 0
+        self.entries = {}  # movie id: ({sort key: value}, serialized movie json)
+        self._orders = {}  # sort key: (sorted (value is not None, value, id) keys, ids in the same order)
+
+        self._lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            self._load()
+
+    def refresh(self):
+        """brings the snapshot up to date with the database (only reading the movies that changed since it was built)"""
+
+        version, _ = get_library_version()
+
+        with self._lock:
+            if version == self.version:
+                return
+
+            # changes older than library_changes_kept versions are pruned, so a snapshot that far behind is rebuilt
+            if self.version is None or not 0 < version - self.version <= library_changes_kept:
+                self.entries, self._orders = {}, {}
+                self._update([movie_id for movie_id, in db.session.query(Movie.id)])
+            else:
+                self._update([movie_id for movie_id, in db.session.query(LibraryChange.movie_id).filter(
+                    LibraryChange.version > self.version).distinct()])
+
+            self.source_count = Source.query.count()
+            self.version = version
+
+            if self.path:
+                self._save()
+
+    def _update(self, movie_ids):
+        """re-reads movie_ids (removing those that no longer exist), moving them within the orders built so far"""
+
+        for chunk in chunked(movie_ids, 500):
+            found = set()
+            for movie in Movie.query.options(selectinload(Movie.files)).filter(Movie.id.in_(chunk)):
+                values = {sort: getattr(movie, column.key) for sort, (column, _) in sort_keys.items()}
+                self._reorder(movie.id, values)
+                self.entries[movie.id] = (values, json.dumps(serialize_movie(movie)))
+                found.add(movie.id)
+
+            for movie_id in set(chunk) - found:
+                self._reorder(movie_id, None)
+                self.entries.pop(movie_id, None)
+
+    def _reorder(self, movie_id, values):
+        """moves movie_id to where values (None if it was removed) sort within each order built so far"""
+
+        previous = self.entries[movie_id][0] if movie_id in self.entries else None
+
+        for sort, (keys, ids) in self._orders.items():
+            if previous is not None:
+                index = bisect.bisect_left(keys, (previous[sort] is not None, previous[sort], movie_id))
+                del keys[index], ids[index]
+
+            if values is not None:
+                key = (values[sort] is not None, values[sort], movie_id)
+                index = bisect.bisect_left(keys, key)
+                keys.insert(index, key)
+                ids.insert(index, movie_id)
+
+    def _order(self, sort):
+        """the ascending order of sort (matching the database's, where nulls come first, then ids break ties)"""
+
+        if sort not in self._orders:
+            keys = sorted((values[sort] is not None, values[sort], movie_id)
+                          for movie_id, (values, _) in self.entries.items())
+            self._orders[sort] = (keys, [key[2] for key in keys])
+
+        return self._orders[sort]
+
+    def payload(self, params):
+        """
+        the listing json (as a string) for params (see listing.list_movies) which mustn't include any filter_params
+        raises ValueError for invalid parameters
+        """
+
+        column, descending = sort_order(params)
+        sort = next(sort for sort, (sort_column, _) in sort_keys.items() if sort_column is column)
+        limit = page_limit(params)
+
+        with self._lock:
+            keys, ids = self._order(sort)
+
+            cursor = None
+            if params.get("cursor"):
+                value, last_id = decode_cursor(params["cursor"], column)
+                cursor = (value is not None, value, last_id)
+
+            if descending:
+                end = bisect.bisect_left(keys, cursor) if cursor else len(keys)
+                page = ids[max(0, end - limit):end][::-1]
+                more = end > limit
+            else:
+                start = bisect.bisect_right(keys, cursor) if cursor else 0
+                page = ids[start:start + limit]
+                more = start + limit < len(ids)
+
+            movies = [self.entries[movie_id][1] for movie_id in page]
+
+            next_cursor = None
+            if more and page:
+                next_cursor = encode_cursor(self.entries[page[-1]][0][sort], page[-1])
+
+            payload = '{"movies": [' + ", ".join(movies) + '], "next_cursor": ' + json.dumps(next_cursor)
+            if not params.get("cursor"):
+                payload += f', "movie_count": {len(self.entries)}, "source_count": {self.source_count}'
+
+        return payload + "}"
+
+    def _load(self):
+        with open(self.path, "rb") as snapshot_file:
+            self.version, self.source_count, self.entries = pickle.load(snapshot_file)
+
+    def _save(self):
+        # written to a temporary file that is then renamed so the snapshot on disk is never partially written
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(self.path), suffix=".part", delete=False) as snapshot_file:
+            pickle.dump((self.version, self.source_count, self.entries), snapshot_file, pickle.HIGHEST_PROTOCOL)
+
+        os.replace(snapshot_file.name, self.path)
+
+
+snapshots = {}
+snapshots_lock = threading.Lock()
+
+
+def get_snapshot():
+    """the (up to date) snapshot of the app's library, persisted to SNAPSHOT_PATH if it is set"""
+
+    path = current_app.config["SNAPSHOT_PATH"]
+    if path:
+        path = os.path.join(current_app.root_path, path)
+
+    with snapshots_lock:
+        key = (current_app.config["SQLALCHEMY_DATABASE_URI"], path)
+        if key not in snapshots:
+            snapshots[key] = LibrarySnapshot(path)
+
+        snapshot = snapshots[key]
+
+    snapshot.refresh()
+
+    return snapshot
+
+
+def serves(params):
+    """whether the listing for params can be served from the snapshot (it isn't filtered)"""
+
+    return not any(params.get(name) for name in filter_params)
@@ -1,64 +1,454 @@
 """
 functions for computing the necessary storage of media metadata
 """
+import datetime
 import os
+import time
+from contextlib import contextmanager
 
-from app import create_app, db
-from models import Source, Movie, compute_hash
-from utils import get_flat_movies
+from sqlalchemy import bindparam, func, inspect
 
+from headless import init_headless, root_path, session, setting
+from metrics import StageTimer
+from models import Source, Movie, Directory, compute_hash, bump_library_version
+from scanner import iter_source_files, run_walks
+from utils import chunked, iter_movies, parse_files, mark_movie, video_file_types, parse_cache, PARSER_VERSION
 
-def scan_and_store(*sources):
-    """scans and stores metadata (for media found at sources) into db"""
 
-    movies = {os.path.join(movie.path, movie.filename): movie for movie in Movie.query.all()}
+def scan_and_store(*sources, incremental=False, workers=1, timeout=None, parse_workers=1, batch_size=1000):
+    """
+    scans and stores metadata (for media found at sources) into db
 
-    for source in sources:
-        for scanned_movie in get_flat_movies(source):
-            if not check_movie_exists(movies, scanned_movie):
-                add_movie(scanned_movie)
+    the full scan is a streaming pipeline (walk -> parse -> batched upsert) so memory is bounded by batch_size rather
+    than the size of the sources and movies are committed as they are found
+    workers and timeout control the concurrent walk of sources (see scanner.iter_source_files, or scanner.run_walks for
+    incremental scans) and parse_workers the number of processes used to parse large batches of files (see
+    utils.iter_movies)
+    """
+
+    if incremental:
+        return incremental_scan_and_store(*sources, workers=workers, timeout=timeout, parse_workers=parse_workers,
+                                          batch_size=batch_size)
+
+    # files are marked (flattened into movies) as they are parsed, so parse includes flatten
+    timer = StageTimer()
+    with persisted_parse_cache(), timer.stage("upsert"):
+        files = timer.iterate("walk", iter_source_files([source.address for source in sources], workers=workers,
+                                                        timeout=timeout))
+        store_movies(timer.iterate("parse", iter_movies(files, workers=parse_workers)), batch_size=batch_size)
+
+    timer.observe("full")
+
+
+# paths the parse cache has been loaded from (it is only loaded once per process, after that memory is up to date)
+parse_cache_loaded = set()
+
+
+@contextmanager
+def persisted_parse_cache():
+    """loads the parse cache from PARSE_CACHE_PATH (if set) and saves it once the block has parsed whatever it needed"""
+
+    if not setting("PARSE_CACHE_PATH"):
+        yield
+        return
+
+    path = os.path.join(root_path(), setting("PARSE_CACHE_PATH"))
+    parse_cache.max_entries = setting("PARSE_CACHE_MAX_ENTRIES")
+
+    if path not in parse_cache_loaded:
+        parse_cache.load(path, PARSER_VERSION)
+        parse_cache_loaded.add(path)
+
+    sets = parse_cache.sets
+    yield
+
+    if parse_cache.sets != sets:
+        parse_cache.save(path, PARSER_VERSION)
+
+
+def store_movies(scanned_movies, batch_size=1000):
+    """
+    upsert stage of the streaming scan pipeline, stores scanned movies committing after every batch
+
+    rows are written with bulk (core) inserts and updates, existing movies are looked up as (id, obj_hash) tuples
+    rather than loaded as full objects and each scanned movie's hash is computed once
+    """
+
+    movies_table = Movie.__table__
+    update_statement = movies_table.update().where(movies_table.c.id == bindparam("movie_id"))
+
+    for batch in chunked(scanned_movies, batch_size):
+        existing = {}
+        for chunk in chunked(list({scanned_movie.path for scanned_movie in batch}), 500):
+            # stays within sqlite's limit on bound parameters, the lookup uses the (path, filename) index
+            existing.update({
+                (path, filename): (movie_id, obj_hash)
+                for movie_id, path, filename, obj_hash in session.query(
+                    Movie.id, Movie.path, Movie.filename, Movie.obj_hash).filter(Movie.path.in_(chunk))
+            })
+
+        inserts, updates = {}, []
+        for scanned_movie in batch:
+            row = movie_row(scanned_movie)
+            key = (row["path"], row["filename"])
+
+            if key in existing:
+                movie_id, obj_hash = existing[key]
+                if row["obj_hash"] != obj_hash:
+                    del row["created_at"]
+                    updates.append(dict(row, movie_id=movie_id))
+            else:
+                inserts[key] = row  # keyed so a file scanned twice (overlapping sources) is only inserted once
+
+        changed_ids = [update["movie_id"] for update in updates]
+        if inserts:
+            # ids are allocated in increasing order so the inserted movies are those beyond the current last one
+            last_id = session.query(func.max(Movie.id)).scalar() or 0
+            session.execute(movies_table.insert(), list(inserts.values()))
+            changed_ids += [movie_id for movie_id, in session.query(Movie.id).filter(Movie.id > last_id)]
+        if updates:
+            session.execute(update_statement, updates)
+        if changed_ids:
+            bump_library_version(changed_ids)
+
+        session.commit()
+
+
+def movie_row(movie):
+    """the movies table row for a scanned movie"""
+
+    return {
+        "created_at": datetime.datetime.utcnow(),
+        "path": movie.path,
+        "filename": movie.original_filename,
+        "_marked_codec": movie.codec,
+        "_marked_edition": movie.edition,
+        "_marked_resolution": movie.resolution,
+        "_marked_sample": movie.sample,
+        "_marked_source": movie.source,
+        "_marked_title": movie.title,
+        "_marked_year": movie.year,
+        "obj_hash": compute_movie_hash(movie),
+    }
+
+
+def incremental_scan_and_store(*sources, workers=1, timeout=None, parse_workers=1, batch_size=1000):
+    """
+    scans and stores metadata (for media found at sources) into db, only re-listing directories whose mtime has changed
+    since the last scan and only parsing files that are new or whose size/mtime has changed
+
+    sources are walked on up to workers threads, a source that is unavailable or whose walk fails or takes longer than
+    timeout seconds is skipped and its stored state left untouched
+    """
+
+    directories = {directory.path: directory for directory in session.query(Directory).all()}
+    mtimes = {path: directory.mtime for path, directory in directories.items()}
+
+    children = {}
+    for directory in directories.values():
+        children.setdefault(directory.parent_path, []).append(directory.path)
+
+    def walk(root, deadline):
+        if not os.path.isdir(root):
+            return None  # source is unavailable (e.g. unmounted)
+
+        visited, listed = set(), []
+        scan_directory(root, None, mtimes, children, visited, listed, deadline=deadline)
+        return visited, listed
+
+    timer = StageTimer()
+    # nothing is written while walking (which can be slow) so that the database isn't locked for the whole walk
+    with timer.stage("walk"):
+        walked = run_walks([source.address.rstrip(os.sep) for source in sources], walk, workers=workers,
+                           timeout=timeout)
+    store_walks(walked, directories, timer, parse_workers, batch_size)
+
+    timer.observe("incremental")
+
+
+def rescan_directories(paths, roots, workers=1, timeout=None, parse_workers=1, batch_size=1000):
+    """
+    rescans just paths (directories seen to change, e.g. by the watcher) below the source roots and stores the changes
+
+    each of paths is listed even if its mtime is unchanged (writing to a file doesn't change its directory's mtime),
+    below them unchanged directories are skipped as in incremental_scan_and_store
+    """
+
+    directories, children, parent_paths = {}, {}, {}
+
+    # paths below another of paths are scanned (and still listed) as part of it
+    forced = {path.rstrip(os.sep) for path in paths}
+    paths = [path for path in forced if not any(path.startswith(other + os.sep) for other in forced)]
+
+    for path in paths:
+        root = next((root for root in roots if path == root or path.startswith(root + os.sep)), None)
+        if root is None:
+            continue  # outside the sources, so its stored state is left untouched
+
+        # (like is case insensitive in sqlite, so the matches are checked again)
+        stored = session.query(Directory).filter(
+            (Directory.path == path) | Directory.path.startswith(path + os.sep, autoescape=True)).all()
+        for directory in stored:
+            if directory.path != path and not directory.path.startswith(path + os.sep):
+                continue
+
+            directories[directory.path] = directory
+            children.setdefault(directory.parent_path, []).append(directory.path)
+
+        parent_path = directories[path].parent_path if path in directories else os.path.dirname(path)
+        parent_paths[path] = (root, parent_path if path != root else None)
+
+    mtimes = {path: directory.mtime for path, directory in directories.items()}
+
+    def walk(path, deadline):
+        root, parent_path = parent_paths[path]
+        if not os.path.isdir(root):
+            return None  # the source is unavailable
+
+        visited, listed = set(), []
+        scan_directory(path, parent_path, mtimes, children, visited, listed, forced=forced, deadline=deadline)
+        return visited, listed
+
+    timer = StageTimer()
+    with timer.stage("walk"):
+        walked = run_walks(list(parent_paths), walk, workers=workers, timeout=timeout)
+    store_walks(walked, directories, timer, parse_workers, batch_size)
+
+    timer.observe("rescan")
+
+
+def store_walks(walked, directories, timer, parse_workers, batch_size=1000):
+    """
+    reconciles and stores the walks (root: (visited, listed) or None) of scan_directory that finished, the walks that
+    didn't (or found their source unavailable) leave the stored state below their roots untouched
+
+    the time taken is attributed to the walk (reconciling the listed files), parse and upsert stages of timer
+    """
+
+    roots, visited, listed, pending = [], set(), [], []
+    for root, result in walked.items():
+        if result is not None:
+            roots.append(root)
+            visited |= result[0]
+            listed += result[1]
+
+    # nothing is written until the pending files have been parsed
+    with session.no_autoflush, timer.stage("walk"):
+        for path, _, _, files in listed:
+            reconcile_directory_files(path, files, pending)
+
+    store_scan(roots, directories, visited, pending, listed, timer, parse_workers, batch_size)
+
+
+def store_scan(roots, directories, visited, pending, listed, timer, parse_workers, batch_size=1000):
+    """
+    parses and stores the new and changed files pending after scanning roots, records the mtimes of the directories
+    listed and removes the directories below roots (or roots themselves) that weren't visited
+
+    files are committed batch_size at a time so that the database is only ever locked briefly, directories are only
+    stored once all of their files have been so that an interrupted scan lists them again
+    """
+
+    # new and changed files are parsed together once the walk is done so a large import can use every core
+    with persisted_parse_cache(), timer.stage("parse"):
+        parsed = parse_files([(filename, os.path.basename(path)) for path, filename, _, _ in pending],
+                             workers=parse_workers)
+
+    with timer.stage("upsert"), unexpired_commits():
+        for batch in chunked(zip(pending, parsed), batch_size):
+            for (path, filename, stat, movie), values in batch:
+                store_scanned_file(path, filename, stat, movie, values)
+            session.commit()
+
+        for path, parent_path, mtime, _ in listed:
+            if path in directories:
+                directories[path].mtime = mtime
             else:
-                update_movie(movies, scanned_movie)
+                directories[path] = Directory(path, parent_path, mtime)
+                session.add(directories[path])
+
+        # anything stored under a scanned root that was not reached has since been removed
+        for path, directory in directories.items():
+            if path not in visited and any(path == root or path.startswith(root + os.sep) for root in roots):
+                remove_directory(directory)
+
+        session.commit()
+
+
+@contextmanager
+def unexpired_commits():
+    """
+    commits in the block don't expire the session's objects, so the stored movies and directories a scan still has to
+    update aren't each reloaded with a select of their own after every batch
+    """
+
+    current = session()
+    expire_on_commit, current.expire_on_commit = current.expire_on_commit, False
+    try:
+        yield
+    finally:
+        current.expire_on_commit = expire_on_commit
+
+
+def scan_directory(path, parent_path, mtimes, children, visited, listed, forced=(), deadline=None):
+    """
+    recursively scans path, using the stored mtime of each directory (path: mtime) to decide whether it needs to be
+    listed again (those in forced are always listed), directories listed are added to listed as (path, parent path,
+    mtime, files as name: stat)
+
+    an unchanged directory costs a single stat as its subdirectories are taken from the stored state, the database isn't
+    touched so that scans can run on other threads
+    raises TimeoutError if the scan is still going at deadline (a time.monotonic() time)
+    """
+
+    if deadline is not None and time.monotonic() > deadline:
+        raise TimeoutError(f"timed out scanning {path}")
+
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return
+
+    visited.add(path)
+
+    if mtimes.get(path) == mtime and path not in forced:
+        subdirectories = children.get(path, [])
+    else:
+        subdirectories, files = [], {}
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subdirectories.append(entry.path)
+                    else:
+                        files[entry.name] = entry.stat()
+        except OSError:
+            # directory can't be listed right now, keep what we know about it so it is retried next time
+            subdirectories = children.get(path, [])
+        else:
+            listed.append((path, parent_path, mtime, files))
 
-    db.session.commit()
+    for subdirectory in subdirectories:
+        scan_directory(subdirectory, path, mtimes, children, visited, listed, forced, deadline)
+
+
+def reconcile_directory_files(path, files, pending):
+    """
+    reconciles the movies stored for path against the files (name: stat) currently in it
+
+    removed files are deleted straight away, new and changed files are added to pending as (path, filename, stat,
+    stored movie or None) to be parsed and stored
+    """
+
+    movies = {os.path.join(movie.path, movie.filename): movie for movie in session.query(Movie).filter_by(path=path)}
+
+    for filename, stat in files.items():
+        movie = movies.pop(os.path.join(path, filename), None)
+        if movie is not None and movie.file_size == stat.st_size and movie.file_mtime == stat.st_mtime_ns:
+            continue  # unchanged since last scan
+
+        if filename[-3:] in video_file_types:
+            pending.append((path, filename, stat, movie))
+
+    # whatever is left has been removed from the directory
+    for movie in movies.values():
+        session.delete(movie)
+
+
+def store_scanned_file(path, filename, stat, movie, values):
+    """stores the parsed values (see utils.parse_file) of a new or changed file"""
+
+    if not values or values.sample:
+        if movie is not None:
+            session.delete(movie)
+        return
+
+    scanned_movie = mark_movie(path, filename, values)
+    if movie is None:
+        movie = add_movie(scanned_movie)
+    else:
+        update_movie({os.path.join(path, filename): movie}, scanned_movie)
+
+    movie.file_size = stat.st_size
+    movie.file_mtime = stat.st_mtime_ns
+
+
+def remove_directory(directory):
+    for movie in session.query(Movie).filter_by(path=directory.path):
+        session.delete(movie)
+
+    session.delete(directory)
 
 
 def add_movie(movie):
-    db.session.add(
-        Movie(movie["path"], movie["marked"]["original_filename"],
-              marked_codec=movie["marked"]["codec"], marked_edition=movie["marked"]["edition"],
-              marked_resolution=movie["marked"]["resolution"], marked_sample=movie["marked"]["sample"],
-              marked_source=movie["marked"]["source"], marked_title=movie["marked"]["title"],
-              marked_year=movie["marked"]["year"])
-    )
+    new_movie = Movie(movie.path, movie.original_filename, marked_codec=movie.codec, marked_edition=movie.edition,
+                      marked_resolution=movie.resolution, marked_sample=movie.sample, marked_source=movie.source,
+                      marked_title=movie.title, marked_year=movie.year)
+    session.add(new_movie)
+
+    return new_movie
 
 
 def update_movie(movies, scanned_movie):
-    movie_to_update = movies[os.path.join(scanned_movie["path"], scanned_movie["marked"]["original_filename"])]
+    movie_to_update = movies[os.path.join(scanned_movie.path, scanned_movie.original_filename)]
 
     if compute_movie_hash(scanned_movie) != movie_to_update.obj_hash:
-        movie_to_update.marked_codec = scanned_movie["marked"]["codec"]
-        movie_to_update.marked_edition = scanned_movie["marked"]["edition"]
-        movie_to_update.marked_resolution = scanned_movie["marked"]["resolution"]
-        movie_to_update.marked_sample = scanned_movie["marked"]["sample"]
-        movie_to_update.marked_source = scanned_movie["marked"]["source"]
-        movie_to_update.marked_title = scanned_movie["marked"]["title"]
-        movie_to_update.marked_year = scanned_movie["marked"]["year"]
+        movie_to_update.marked_codec = scanned_movie.codec
+        movie_to_update.marked_edition = scanned_movie.edition
+        movie_to_update.marked_resolution = scanned_movie.resolution
+        movie_to_update.marked_sample = scanned_movie.sample
+        movie_to_update.marked_source = scanned_movie.source
+        movie_to_update.marked_title = scanned_movie.title
+        movie_to_update.marked_year = scanned_movie.year
 
 
 def check_movie_exists(movies, movie):
-    return os.path.join(movie["path"], movie["marked"]["original_filename"]) in movies
+    return os.path.join(movie.path, movie.original_filename) in movies
+
+
+def rehash_movies(batch_size=1000):
+    """
+    recomputes the object hash of every stored movie (and creates its index) - a one time migration of databases
+    storing md5 hex digests from before the hash was a 64 bit integer
+    returns the number of movies rehashed
+    """
+
+    movies_table = Movie.__table__
+    connection = session.connection()
+    existing_indexes = {index["name"] for index in inspect(connection).get_indexes(movies_table.name)}
+    for index in movies_table.indexes:
+        if index.name not in existing_indexes:
+            index.create(connection)
+
+    update_statement = movies_table.update().where(movies_table.c.id == bindparam("movie_id"))
+    columns = [Movie.id, Movie.path, Movie.filename, Movie._marked_codec, Movie._marked_edition,
+               Movie._marked_resolution, Movie._marked_sample, Movie._marked_source, Movie._marked_title,
+               Movie._marked_year]
+
+    rehashed, last_id = 0, 0
+    while True:
+        rows = session.query(*columns).filter(Movie.id > last_id).order_by(Movie.id).limit(batch_size).all()
+        if not rows:
+            break
+
+        session.execute(update_statement, [{"movie_id": row[0], "obj_hash": compute_hash(*row[1:])} for row in rows])
+        session.commit()
+
+        rehashed += len(rows)
+        last_id = rows[-1][0]
+
+    return rehashed
 
 
 def compute_movie_hash(movie):
-    return compute_hash(movie["path"], movie["marked"]["original_filename"], movie["marked"]["codec"],
-                        movie["marked"]["edition"], movie["marked"]["resolution"], movie["marked"]["sample"],
-                        movie["marked"]["source"], movie["marked"]["title"], movie["marked"]["year"])
+    return compute_hash(movie.path, movie.original_filename, movie.codec, movie.edition, movie.resolution,
+                        movie.sample, movie.source, movie.title, movie.year)
 
 
 if __name__ == '__main__':
-    with create_app().app_context():
-        # Movie.query.delete()
-        # db.session.commit()
+    init_headless()
 
-        scan_and_store(*Source.query.all())
+    scan_and_store(*session.query(Source).all(), incremental=True, workers=setting("SCAN_WORKERS"),
+                   timeout=setting("SCAN_TIMEOUT"), parse_workers=setting("PARSE_WORKERS"),
+                   batch_size=setting("SCAN_BATCH_SIZE"))
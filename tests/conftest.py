@@ -0,0 +1,57 @@
+import os
+import sys
+
+import pytest
+
+# the modules live at the top of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config  # noqa: E402
+
+
+@pytest.fixture
+def config(tmp_path):
+    class TestConfig(Config):
+        TESTING = True
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{tmp_path / 'app.db'}"
+        PARSE_CACHE_PATH = ""
+        TMDB_CACHE_PATH = ""
+        SNAPSHOT_PATH = None
+
+    return TestConfig
+
+
+@pytest.fixture
+def headless_session(config):
+    """the plain session (see headless.init_headless) bound to a database with its tables created, as cli.py runs"""
+
+    import headless
+    from app import db
+    import models  # noqa: F401 (registers the tables)
+
+    engine = headless.init_headless(config)
+    db.Model.metadata.create_all(engine)
+    yield headless.session
+
+    headless.session.remove()
+    headless.headless_session = None
+    headless.settings.clear()
+    engine.dispose()
+
+
+@pytest.fixture
+def web_app(config, tmp_path, monkeypatch):
+    """the web app with its tables created (run from tmp_path, where it creates its static directories)"""
+
+    from app import create_app, db
+
+    monkeypatch.chdir(tmp_path)
+    app = create_app(config)
+    with app.app_context():
+        db.create_all()
+        db.session.remove()
+
+    yield app
+
+    with app.app_context():
+        db.get_engine(app).dispose()
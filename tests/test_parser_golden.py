@@ -0,0 +1,62 @@
+"""
+the parsers against the golden corpus (tests/fixtures/parser_golden.json) and the original parser (the legacy functions
+kept in benchmark.py)
+"""
+import os
+
+import pytest
+
+import benchmark
+import utils
+
+golden = benchmark.load_golden()
+
+# forms of resolution the original parser didn't recognise
+additional_resolutions = ("4k", "uhd", "i")
+
+
+@pytest.mark.parametrize("entry", golden["names"], ids=lambda entry: repr(entry["name"]))
+def test_year_and_resolution(entry):
+    assert utils.parse_year(entry["name"]) == entry["year"]
+    assert utils.parse_resolution(entry["name"]) == entry["resolution"]
+
+
+@pytest.mark.parametrize("entry", golden["names"], ids=lambda entry: repr(entry["name"]))
+def test_year_and_resolution_match_legacy_parser(entry):
+    assert benchmark.legacy_parse_year(entry["name"]) == entry["year"]
+    if not entry["resolution"].endswith(additional_resolutions):
+        assert benchmark.legacy_parse_resolution(entry["name"]) == entry["resolution"]
+
+
+def test_years_after_the_current_year_are_ignored():
+    assert utils.parse_year(f"Movie {utils.current_year + 1}") == ""
+    assert utils.parse_year(f"Movie {utils.current_year}") == str(utils.current_year)
+
+
+@pytest.mark.parametrize("entry", golden["folders"], ids=lambda entry: entry["folder"])
+def test_folder_tags(entry):
+    expected = (entry["source"], entry["edition"], entry["codec"])
+
+    assert tuple(tag for tag, _ in benchmark.folder_tags(entry["folder"])) == expected
+    assert tuple(tag for tag, _ in benchmark.legacy_parse_folder_tags(entry["folder"])) == expected
+
+
+@pytest.mark.parametrize("entry", golden["files"], ids=lambda entry: entry["file"])
+def test_parse_file(entry):
+    utils.parse_cache.clear()
+
+    assert utils.parse_file(entry["file"], entry["folder"])._asdict() == entry["parsed"]
+
+
+def test_generated_names_match_legacy_parser():
+    names = benchmark.generate_filenames(2000, seed=1)
+    cleaned = [utils.parse_name(name) for name in names] + benchmark.generate_awkward_names(2000, seed=1)
+
+    assert [utils.parse_tags(name) for name in names] == [benchmark.legacy_parse_tags(name) for name in names]
+    assert [utils.parse_year(name) for name in cleaned] == [benchmark.legacy_parse_year(name) for name in cleaned]
+    assert [utils.parse_resolution(name) for name in cleaned] == [
+        benchmark.legacy_parse_resolution(name) for name in cleaned]
+
+    folders = [os.path.splitext(name)[0] for name in names]
+    assert [benchmark.folder_tags(folder) for folder in folders] == [
+        benchmark.legacy_parse_folder_tags(folder) for folder in folders]
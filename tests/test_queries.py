@@ -0,0 +1,59 @@
+import pytest
+
+from app import db
+from instrumentation import _local, count_queries
+from models import File, Movie
+
+
+def add_movies(count):
+    for i in range(count):
+        movie = Movie(f"/library/Film {i}", f"Film.{i}.{1950 + i % 70}.{('720p', '1080p')[i % 2]}.mkv",
+                      marked_resolution=("720p", "1080p")[i % 2], marked_title=f"Film {i}",
+                      marked_year=str(1950 + i % 70))
+        movie.files = [File("poster.jpg", "poster"), File("thumb.jpg", "thumb")]
+        db.session.add(movie)
+    db.session.commit()
+
+
+def statement_counts(app, size, urls):
+    """the number of statements each of urls (formatted with the id of the last movie) executes with size movies"""
+
+    with app.app_context():
+        add_movies(size)
+        last_id = db.session.query(db.func.max(Movie.id)).scalar()
+        db.session.remove()
+
+    client, counts = app.test_client(), []
+    for url in urls:
+        url = url.format(movie_id=last_id)
+        client.get(url)  # (warms up the snapshot and the response cache's versions)
+        with count_queries() as statements:
+            response = client.get(url)
+        assert response.status_code == 200
+        assert response.headers["X-Query-Count"] == str(len(statements))
+        counts.append(len(statements))
+
+    return counts
+
+
+@pytest.mark.parametrize("urls", [
+    ["/api/movies?limit=500", "/api/movies?limit=500&resolution=1080p", "/api/movies?limit=500&sort=title"],
+    ["/api/movie/{movie_id}"],
+])
+def test_statement_count_is_independent_of_library_size(config, tmp_path, monkeypatch, urls):
+    from app import create_app
+
+    config.QUERY_COUNT_HEADER = True
+    counts = []
+    for size in (20, 200):
+        config.SQLALCHEMY_DATABASE_URI = f"sqlite:///{tmp_path / f'{size}.db'}"
+        monkeypatch.chdir(tmp_path)
+        app = create_app(config)
+        with app.app_context():
+            db.create_all()
+        counts.append(statement_counts(app, size, urls))
+        with app.app_context():
+            db.get_engine(app).dispose()
+
+    assert counts[0] == counts[1]
+    assert not _local.recorders
@@ -0,0 +1,39 @@
+import os
+import time
+
+import jobs
+from app import db
+from models import Source
+
+
+def test_local_movies_only_submits_jobs_on_post(web_app, tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "scan_jobs", None)
+    library = tmp_path / "library" / "Heat (1995)"
+    os.makedirs(library)
+    (library / "Heat.1995.1080p.BluRay.mkv").touch()
+    with web_app.app_context():
+        db.session.add(Source(str(tmp_path / "library")))
+        db.session.commit()
+        db.session.remove()
+
+    client = web_app.test_client()
+    assert client.get("/local_movies").status_code == 404
+
+    response = client.post("/local_movies")
+    assert response.status_code == 202
+    job_id = response.get_json()["id"]
+
+    # getting it again returns the same job rather than starting another one
+    response = client.get("/local_movies")
+    assert response.status_code == 200
+    assert response.get_json()["id"] == job_id
+    assert response.headers["Location"].endswith(f"/scan_jobs/{job_id}")
+
+    deadline = time.monotonic() + 10
+    while client.get(f"/scan_jobs/{job_id}").get_json()["status"] not in ("finished", "failed"):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+    movies = client.get(f"/scan_jobs/{job_id}/movies").get_json()["movies"]
+    assert [movie["marked"]["title"] for movie in movies] == ["Heat"]
+    assert client.get("/local_movies").get_json()["id"] == job_id
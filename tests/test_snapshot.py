@@ -0,0 +1,40 @@
+import json
+
+from app import db
+from listing import sort_keys
+from models import Movie
+from snapshot import LibrarySnapshot
+
+
+def listings(snapshot):
+    return {(sort, order): json.loads(snapshot.payload({"sort": sort, "order": order, "limit": "500"}))
+            for sort in sort_keys for order in ("asc", "desc")}
+
+
+def test_refresh_keeps_built_orders_up_to_date(web_app):
+    with web_app.app_context():
+        for i in range(30):
+            movie = Movie(f"/library/Film {i}", f"Film.{i}.mkv", marked_title=f"Film {i}")
+            movie.title, movie.popularity = f"Film {i % 7}", (i % 5 or None)
+            db.session.add(movie)
+        db.session.commit()
+
+        snapshot = LibrarySnapshot()
+        snapshot.refresh()
+        listings(snapshot)  # (builds every order)
+
+        movies = Movie.query.order_by(Movie.id).all()
+        movies[0].title, movies[3].popularity, movies[4].popularity = "A Film", None, 10.0
+        db.session.delete(movies[5])
+        added = Movie("/library/Film 30", "Film.30.mkv", marked_title="Film 30")
+        added.title, added.popularity = "Film 3", 2.0
+        db.session.add(added)
+        db.session.commit()
+
+        snapshot.refresh()
+        rebuilt = LibrarySnapshot()
+        rebuilt.refresh()
+
+        assert listings(snapshot) == listings(rebuilt)
+        assert len(snapshot.entries) == 30
+        db.session.remove()
@@ -0,0 +1,67 @@
+import os
+import threading
+import time
+
+from app import db
+from models import Movie, Source
+from store import scan_and_store
+
+
+def write_library(root, count):
+    for i in range(count):
+        directory = os.path.join(root, f"Film {i} ({1950 + i % 70})")
+        os.makedirs(directory)
+        open(os.path.join(directory, f"Film.{i}.{1950 + i % 70}.{('720p', '1080p')[i % 2]}.BluRay.mkv"), "w").close()
+
+
+def test_listing_while_scanning(web_app, tmp_path):
+    library = str(tmp_path / "library")
+    write_library(library, 300)
+
+    def scan():
+        with web_app.app_context():
+            scan_and_store(Source(library), batch_size=20)
+            db.session.remove()
+
+    client, requests, failed = web_app.test_client(), 0, []
+    scanner = threading.Thread(target=scan)
+    scanner.start()
+    while scanner.is_alive() or not requests:
+        url = "/api/movies?limit=50" + ("&resolution=1080p" if requests % 2 else "")
+        response = client.get(url)
+        requests += 1
+        if response.status_code != 200:
+            failed.append((url, response.status_code))
+    scanner.join()
+
+    assert not failed
+    assert client.get("/api/movies?limit=500").get_json()["movie_count"] == 300
+
+
+def test_readers_dont_wait_for_a_writer(web_app, tmp_path):
+    library = str(tmp_path / "library")
+    write_library(library, 20)
+    with web_app.app_context():
+        scan_and_store(Source(library))
+        db.session.remove()
+        engine = db.get_engine(web_app)
+
+    writer = engine.raw_connection()
+    try:
+        assert writer.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+        # an exclusive lock with uncommitted changes - without write ahead logging, readers would wait it out
+        writer.execute("BEGIN EXCLUSIVE")
+        writer.execute(f"DELETE FROM {Movie.__tablename__}")
+
+        client = web_app.test_client()
+        start = time.perf_counter()
+        response = client.get("/api/movies?limit=50&resolution=1080p")
+        seconds = time.perf_counter() - start
+
+        assert response.status_code == 200
+        assert response.get_json()["movie_count"] == 10
+        assert seconds < web_app.config["SQLITE_BUSY_TIMEOUT"] / 1000 / 2
+    finally:
+        writer.rollback()
+        writer.close()
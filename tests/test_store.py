@@ -0,0 +1,53 @@
+import os
+
+from models import Directory, Movie, Source
+from store import rescan_directories, scan_and_store
+
+
+def write(path, content=""):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as file:
+        file.write(content)
+
+
+def test_incremental_scan(headless_session, tmp_path):
+    library = str(tmp_path / "library")
+    write(os.path.join(library, "Heat (1995)", "Heat.1995.1080p.BluRay.mkv"))
+    write(os.path.join(library, "Alien (1979)", "Alien.1979.720p.mkv"))
+    write(os.path.join(library, "Alien (1979)", "Alien.1979.720p.nfo"))
+
+    scan_and_store(Source(library), incremental=True)
+
+    assert sorted(movie.marked_title for movie in headless_session.query(Movie)) == ["Alien", "Heat"]
+    assert headless_session.query(Directory).count() == 3
+
+    os.remove(os.path.join(library, "Heat (1995)", "Heat.1995.1080p.BluRay.mkv"))
+    scan_and_store(Source(library), incremental=True)
+
+    assert [movie.marked_title for movie in headless_session.query(Movie)] == ["Alien"]
+
+
+def test_incremental_scan_skips_sources_that_time_out(headless_session, tmp_path):
+    library = str(tmp_path / "library")
+    write(os.path.join(library, "Heat (1995)", "Heat.1995.1080p.BluRay.mkv"))
+    scan_and_store(Source(library), incremental=True)
+
+    os.remove(os.path.join(library, "Heat (1995)", "Heat.1995.1080p.BluRay.mkv"))
+    scan_and_store(Source(library), incremental=True, workers=2, timeout=0)
+
+    # the walk timed out, so what is stored for the source is left alone
+    assert headless_session.query(Movie).count() == 1
+
+
+def test_rescan_lists_changed_directories_below_other_changed_directories(headless_session, tmp_path):
+    library = str(tmp_path / "library")
+    parent, child = os.path.join(library, "Heat (1995)"), os.path.join(library, "Heat (1995)", "Heat")
+    write(os.path.join(child, "Heat.1995.1080p.BluRay.mkv"))
+    scan_and_store(Source(library), incremental=True)
+
+    # rewriting a file doesn't change its directory's mtime, whereas creating one does
+    write(os.path.join(child, "Heat.1995.1080p.BluRay.mkv"), "rewritten")
+    write(os.path.join(parent, "Heat.1995.nfo"))
+    rescan_directories([parent, child], [library])
+
+    assert headless_session.query(Movie).one().file_size == len("rewritten")
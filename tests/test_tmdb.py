@@ -0,0 +1,139 @@
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import headless
+import tmdb
+from enrich import enrich_movies
+from models import Movie
+
+movie_data = {"id": 949, "imdb_id": "tt0113277", "title": "Heat", "original_title": "Heat", "overview": "",
+              "adult": False, "popularity": 30.5, "release_date": "1995-12-15", "revenue": 187436818, "runtime": 170,
+              "status": "Released", "tagline": "", "vote_average": 7.9, "vote_count": 6000, "poster_path": None}
+
+
+class StubTMDB:
+    """a local stand in for the TMDB api, serving queued responses for each path (and query)"""
+
+    def __init__(self):
+        self.responses = {}  # (path, query or None): (status, body, headers) served in order, the last one repeatedly
+        self.requests = []  # (time, path, query) of every request
+        self.lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                status, body, headers = stub.serve(self.path)
+
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/3/"
+
+    def respond(self, path, *responses, query=None):
+        """queues responses (bodies, or (status, body, headers)) for path, only for requests for query if it is given"""
+
+        self.responses["/3/" + path, query] = [
+            response if isinstance(response, tuple) else (200, response, {}) for response in responses]
+
+    def serve(self, url):
+        url = urllib.parse.urlparse(url)
+        query = urllib.parse.parse_qs(url.query).get("query", [None])[0]
+
+        with self.lock:
+            self.requests.append((time.monotonic(), url.path, query))
+            queued = self.responses.get((url.path, query)) or self.responses.get((url.path, None))
+            if not queued:
+                return 404, {"status_message": "not found"}, {}
+
+            return queued.pop(0) if len(queued) > 1 else queued[0]
+
+    def times(self, path, query=None):
+        """when path (for query, if it is given) was requested"""
+
+        return [at for at, requested, requested_query in self.requests
+                if requested == "/3/" + path and query in (None, requested_query)]
+
+
+@pytest.fixture
+def stub_tmdb(headless_session):
+    stub = StubTMDB()
+    threading.Thread(target=stub.server.serve_forever, daemon=True).start()
+
+    headless.configure(TMDB_BASE_URL=stub.url, TMDB_API_KEY="key", TMDB_BACKOFF=0.01, TMDB_MAX_RETRIES=3)
+    yield stub
+
+    stub.server.shutdown()
+    stub.server.server_close()
+
+
+def test_server_errors_are_retried(stub_tmdb):
+    stub_tmdb.respond("movie/949", (500, {}, {}), (503, {}, {}), movie_data)
+
+    assert tmdb.get_movie_data(949)["title"] == "Heat"
+    assert len(stub_tmdb.times("movie/949")) == 3
+
+
+def test_requests_give_up_after_max_retries(stub_tmdb):
+    stub_tmdb.respond("movie/949", (502, {}, {}))
+
+    with pytest.raises(tmdb.TMDBError) as error:
+        tmdb.get_movie_data(949)
+
+    assert error.value.status_code == 502
+    assert len(stub_tmdb.times("movie/949")) == 4
+
+
+def test_rate_limited_requests_wait_for_retry_after(stub_tmdb):
+    stub_tmdb.respond("movie/949", (429, {}, {"Retry-After": "1"}), movie_data)
+
+    assert tmdb.get_movie_data(949)["id"] == 949
+
+    first, second = stub_tmdb.times("movie/949")
+    assert second - first >= 1  # rather than the 0.01s backoff
+
+
+def test_requests_are_rate_limited_across_threads(stub_tmdb):
+    headless.configure(TMDB_REQUESTS_PER_SECOND=10.0)  # (a burst of 10, then one request every 0.1s)
+    stub_tmdb.respond("movie/949", movie_data)
+
+    threads = [threading.Thread(target=lambda: [tmdb.get_movie_data(949) for _ in range(5)]) for _ in range(3)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(stub_tmdb.times("movie/949")) == 15
+    assert time.monotonic() - start >= 0.45
+
+
+def test_enrichment_carries_on_past_failed_lookups(stub_tmdb, headless_session, caplog):
+    for title in ("Heat", "Alien", "Ronin"):
+        headless_session.add(Movie(f"/library/{title}", f"{title}.mkv", marked_title=title))
+    headless_session.commit()
+
+    stub_tmdb.respond("search/movie", {"results": [{"id": 949}]}, query="Heat")
+    stub_tmdb.respond("search/movie", (500, {}, {}), query="Alien")
+    stub_tmdb.respond("search/movie", {"page": 1}, query="Ronin")  # (an unexpected response, without results)
+    stub_tmdb.respond("movie/949", movie_data)
+
+    assert enrich_movies(workers=2) == 1
+    assert [movie.title for movie in headless_session.query(Movie).order_by(Movie.id)] == ["Heat", None, None]
+    assert len(stub_tmdb.times("search/movie", "Alien")) == 4
+    assert "KeyError: 'results'" in caplog.text
@@ -1,46 +1,229 @@
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
 import requests
-from flask import current_app
+from requests.adapters import HTTPAdapter
 import urllib
 import urllib.parse
 
+import metrics
+from headless import root_path, setting
+from tmdb_cache import ResponseCache, cache_key, endpoint_group
+
 """
 this file is a collation of interface functions for the TMDB API
 """
 
+# shared so that connections are kept alive and reused across calls (and threads)
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
 
-def search_movies(name, year=None):
-    response = requests.get(url=build_url("search/movie", query=name, year=year))
+retry_statuses = {429, 500, 502, 503, 504}
+
+# the permissions of downloaded images - those of any new file, as temporary files are only readable by their owner
+# (the umask is read once, at import, as reading it means setting it)
+umask = os.umask(0)
+os.umask(umask)
+image_mode = 0o644 & ~umask
+
+
+class TMDBError(Exception):
+    """raised when a TMDB request fails (after any retries)"""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class RateLimiter:
+    """token bucket limiting the rate of requests (shared by all threads)"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """blocks until a request may be made"""
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    rate = setting("TMDB_REQUESTS_PER_SECOND")
+
+    with rate_limiters_lock:
+        if rate not in rate_limiters:
+            rate_limiters[rate] = RateLimiter(rate)
+
+        return rate_limiters[rate]
+
+
+def get(url, stream=False):
+    """
+    makes a (rate limited) GET request to TMDB, retrying with exponential backoff on connection errors, rate limiting
+    and server errors
+    raises TMDBError if the request still fails
+    """
+
+    max_retries = setting("TMDB_MAX_RETRIES")
+    rate_limiter = get_rate_limiter()
+
+    for attempt in range(max_retries + 1):
+        rate_limiter.acquire()
+
+        delay = setting("TMDB_BACKOFF") * 2 ** attempt
+        start = time.perf_counter()
+        try:
+            response = session.get(url=url, timeout=setting("TMDB_TIMEOUT"), stream=stream)
+        except requests.RequestException as e:
+            if metrics.enabled:
+                metrics.observe_tmdb_request(endpoint_label(url), "error", time.perf_counter() - start)
+            if attempt == max_retries:
+                raise TMDBError(f"request failed: {e}")
+        else:
+            if metrics.enabled:
+                metrics.observe_tmdb_request(endpoint_label(url), str(response.status_code),
+                                             time.perf_counter() - start)
+
+            if response.status_code == 200:
+                return response
+
+            if response.status_code not in retry_statuses or attempt == max_retries:
+                raise TMDBError(f"request failed with status {response.status_code}", response.status_code)
+
+            retry_after = response.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            response.close()
 
-    if response.status_code == 200:
-        return response.json()
+        time.sleep(delay)
 
-    # TODO: implement a custom error and raise it whenever status code is not 200
+
+def endpoint_label(url):
+    """the endpoint of url (with ids replaced and every image as "image") for labelling metrics"""
+
+    if url.startswith(setting("TMDB_IMAGE_URL")):
+        return "image"
+
+    path, base_path = urllib.parse.urlparse(url).path, urllib.parse.urlparse(setting("TMDB_BASE_URL")).path
+    if path.startswith(base_path):
+        path = path[len(base_path):]
+
+    return re.sub(r"\d+", "{id}", path)
+
+
+caches = {}
+caches_lock = threading.Lock()
+
+
+def get_cache():
+    """the response cache configured by TMDB_CACHE_PATH (None if caching is disabled)"""
+
+    if not setting("TMDB_CACHE_PATH"):
+        return None
+
+    path = os.path.join(root_path(), setting("TMDB_CACHE_PATH"))
+
+    with caches_lock:
+        if path not in caches:
+            caches[path] = ResponseCache(path, max_entries=setting("TMDB_CACHE_MAX_ENTRIES"))
+
+        return caches[path]
+
+
+def get_json(endpoint, **parameters):
+    """GETs the (decoded) response of an API endpoint, served from the response cache while it is fresh"""
+
+    cache = get_cache()
+    if cache is None:
+        return get(build_url(endpoint, **parameters)).json()
+
+    key = cache_key(endpoint, parameters)
+    ttls = setting("TMDB_CACHE_TTLS")
+
+    body = cache.get(key, ttls.get(endpoint_group(endpoint), ttls["default"]))
+    if body is None:
+        body = get(build_url(endpoint, **parameters)).text
+        cache.set(key, body)
+
+    return json.loads(body)
+
+
+def search_movies(name, year=None):
+    return get_json("search/movie", query=name, year=year)
 
 
 def get_movie_data(movie_id):
-    response = requests.get(url=build_url("movie/" + str(movie_id)))
-    return response.json()
+    return get_json("movie/" + str(movie_id))
 
 
 def get_movie_images_data(movie_id, language="en"):
-    response = requests.get(url=build_url("movie/" + str(movie_id) + "/images", language=language))
-    return response.json()
+    return get_json("movie/" + str(movie_id) + "/images", language=language)
+
+
+def get_image(file_path, size="original"):
+    return get(build_url(file_path, image=True, size=size)).content
+
+
+def download_image(file_path, destination, size="original", chunk_size=64 * 1024):
+    """
+    streams an image to destination in chunks (rather than reading it into memory)
+
+    it is written to a temporary file alongside destination which is then renamed, so destination is never left
+    partially written
+    """
+
+    response = get(build_url(file_path, image=True, size=size), stream=True)
+
+    with response, tempfile.NamedTemporaryFile(dir=os.path.dirname(destination), suffix=".part",
+                                               delete=False) as temporary_file:
+        try:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                temporary_file.write(chunk)
+        except BaseException:
+            temporary_file.close()
+            os.remove(temporary_file.name)
+            raise
 
+    os.chmod(temporary_file.name, image_mode)
+    os.replace(temporary_file.name, destination)
 
-def get_image(file_path):
-    response = requests.get(url=build_url(file_path, image=True))
-    return response.content
+    return destination
 
 
-def build_url(endpoint, image=False, **parameters):
-    parameters["api_key"] = current_app.config['TMDB_API_KEY']
+def build_url(endpoint, image=False, size="original", **parameters):
+    parameters["api_key"] = setting("TMDB_API_KEY")
 
     parameters = {k: v for k, v in parameters.items() if v}
 
     if image:
-        base_url = current_app.config['TMDB_IMAGE_URL'] + "original/"
+        base_url = setting("TMDB_IMAGE_URL") + size + "/"
     else:
-        base_url = current_app.config['TMDB_BASE_URL']
+        base_url = setting("TMDB_BASE_URL")
 
     url = urllib.parse.urljoin(base_url, endpoint.strip("/"))
     if not image:
@@ -0,0 +1,97 @@
+"""
+persistent (sqlite backed) cache of TMDB responses with per endpoint TTLs and least recently used eviction
+"""
+import re
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+
+class ResponseCache:
+    """
+    caches response bodies by key, entries expire after the TTL given when they are read and the least recently used
+    entries are evicted once there are more than max_entries
+
+    safe to share between threads
+    """
+
+    def __init__(self, path, max_entries=100000, evict_every=100):
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+
+        self.hits = 0
+        self.misses = 0
+        self._sets = 0
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS responses "
+                                 "(key TEXT PRIMARY KEY, body TEXT, stored_at REAL, accessed_at REAL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS ix_responses_accessed_at ON responses (accessed_at)")
+
+    def get(self, key, ttl):
+        """returns the body stored for key if it is younger than ttl seconds (otherwise None)"""
+
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute("SELECT body, stored_at FROM responses WHERE key = ?", (key,)).fetchone()
+
+            if row is None or now - row[1] > ttl:
+                self.misses += 1
+                return None
+
+            self._connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+
+            return row[0]
+
+    def set(self, key, body):
+        now = time.time()
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO responses (key, body, stored_at, accessed_at) "
+                                     "VALUES (?, ?, ?, ?)", (key, body, now, now))
+
+            self._sets += 1
+            if self._sets % self.evict_every == 0:
+                self._evict()
+
+    def _evict(self):
+        excess = self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0] - self.max_entries
+        if excess > 0:
+            self._connection.execute("DELETE FROM responses WHERE key IN "
+                                     "(SELECT key FROM responses ORDER BY accessed_at LIMIT ?)", (excess,))
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM responses")
+
+    def stats(self):
+        with self._lock:
+            entries = self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+
+def cache_key(endpoint, parameters):
+    """
+    the key of a request - its endpoint and normalised parameters (excluding the api key, empty parameters and
+    differences in whitespace and, for search queries, case)
+    """
+
+    normalised = {}
+    for name, value in parameters.items():
+        if name == "api_key" or not value:
+            continue
+
+        value = " ".join(str(value).split())
+        normalised[name] = value.lower() if name == "query" else value
+
+    return endpoint.strip("/") + "?" + urllib.parse.urlencode(sorted(normalised.items()))
+
+
+def endpoint_group(endpoint):
+    """the endpoint with ids removed (e.g. movie/603/images -> movie/images), used to look up its TTL"""
+
+    return re.sub(r"/\d+", "", "/" + endpoint.strip("/")).lstrip("/")
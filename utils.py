@@ -2,7 +2,14 @@ import datetime
 import os
 import re
 import string
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from functools import reduce
+from itertools import chain, islice
+from typing import NamedTuple
+
+from parse_cache import ParseCache
+from scanner import iter_source_files
 
 sources = {"CAM": ["CAMRip", "CAM", "HDCAM"],
            "TeleSync": ["TS", "HDTS", "HD-TS", "TELESYNC", "PDVD", "PreDVDRip"],
@@ -40,6 +47,8 @@ codecs = {
 }
 codecs = {tag: codec for codec, tags in codecs.items() for tag in tags}  # reverses the above dictionary
 
+video_file_types = ['avi', 'mp4', 'mkv']
+
 current_year = datetime.datetime.now().year
 letters = list(string.ascii_lowercase)
 
@@ -62,22 +71,88 @@ def get_directory_structure(root_directory):
     return directory
 
 
+def build_tag_pattern(tags):
+    """
+    builds a regex matching (zero-width) at every position in a string where any of tags starts
+
+    the alternatives are nested as a trie so tags sharing a prefix are only compared once
+    """
+
+    trie = {}
+    for tag in tags:
+        node = trie
+        for character in tag:
+            node = node.setdefault(character, {})
+        node[""] = True
+
+    def build(node):
+        branches = [re.escape(character) + build(child) for character, child in sorted(node.items()) if character]
+        if not branches:
+            return ""
+        pattern = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        return "(?:" + pattern + ")?" if "" in node else pattern
+
+    return re.compile("(?=" + build(trie) + ")")
+
+
+def build_tag_index(*categories):
+    """
+    indexes the tags of each category by their first (lower case) character as:
+    (lower case tag, category index, priority within category, tag)
+    """
+
+    index = {}
+    for category, category_tags in enumerate(categories):
+        for priority, tag in enumerate(category_tags):
+            index.setdefault(tag.lower()[0], []).append((tag.lower(), category, priority, tag))
+
+    return index
+
+
+tag_index = build_tag_index(sources, editions, codecs)
+tag_pattern = build_tag_pattern(entry[0] for entries in tag_index.values() for entry in entries)
+
+
+def parse_tags(name):
+    """
+    identifies the source, edition and codec used in name in a single pass
+    returns a (value, tag used) pair for each of them
+
+    a tag only counts where it isn't preceded by a letter and, as with checking each tag in turn, tags are tried in the
+    order they are defined (at their first occurrence only)
+    """
+
+    name_lower = name.lower()
+
+    found, seen = ([], [], []), set()
+    for match in tag_pattern.finditer(name_lower):
+        index = match.start()
+        for entry in tag_index[name_lower[index]]:
+            if entry not in seen and name_lower.startswith(entry[0], index):
+                seen.add(entry)
+                found[entry[1]].append((entry[2], index, entry[3]))
+
+    results = []
+    # editions have always checked for a preceding letter in the original (not lower case) name
+    for category_tags, boundary_name, candidates in [(sources, name_lower, found[0]), (editions, name, found[1]),
+                                                     (codecs, name_lower, found[2])]:
+        result = "", ""
+        for _, index, tag in sorted(candidates):
+            if boundary_name[index - 1] not in letters:
+                result = category_tags[tag], name[index:index + len(tag)]
+                break
+        results.append(result)
+
+    return tuple(results)
+
+
 def parse_source(name):
     """
     identifies source used in name
     returns the source and the tag used
     """
 
-    for tag in sources:
-        name_lower = name.lower()
-        try:
-            tag_index = name_lower.index(tag.lower())
-            if name_lower[tag_index - 1] not in letters:
-                return sources[tag], name[tag_index:tag_index + len(tag)]
-        except ValueError:
-            pass
-
-    return "", ""
+    return parse_tags(name)[0]
 
 
 def parse_edition(name):
@@ -86,15 +161,7 @@ def parse_edition(name):
     returns the edition and the tag used
     """
 
-    for edition_tag in editions:
-        try:
-            tag_index = name.lower().index(edition_tag)
-            if name[tag_index - 1] not in letters:
-                return editions[edition_tag], name[tag_index:tag_index + len(edition_tag)]
-        except ValueError:
-            pass
-
-    return "", ""
+    return parse_tags(name)[1]
 
 
 def parse_codec(name):
@@ -103,16 +170,7 @@ def parse_codec(name):
     returns the codec and the tag used
     """
 
-    for codec_tag in codecs:
-        name_lower = name.lower()
-        try:
-            tag_index = name_lower.index(codec_tag.lower())
-            if name_lower[tag_index - 1] not in letters:
-                return codecs[codec_tag], name[tag_index:tag_index + len(codec_tag)]
-        except ValueError:
-            pass
-
-    return "", ""
+    return parse_tags(name)[2]
 
 
 def parse_name(name):
@@ -129,56 +187,39 @@ def parse_name(name):
     return name.strip(' ')
 
 
+# a year is 4 digits not followed by a p (that's a resolution) and, unless it ends the name, not starting it
+year_pattern = re.compile(r"(?=(\d{4})(?:\Z|(?<=[\s\S]{5})(?![pP])))")
+
+# a resolution is the 4 characters before a p when they are an integer as far as int() is concerned (allowing
+# whitespace, a sign and underscores, so " 720p" is a resolution)
+resolution_pattern = re.compile(r"(?=[^pP]{4}[pP])(?=([^\S\x1c-\x1f]*[+-]?\d(?:_?\d)*[^\S\x1c-\x1f]*[pP]))")
+
+# forms of resolution without the p, only looked for when there is no resolution of the form above
+extra_resolution_pattern = re.compile(r"(?<![^\W_])(\d{3,4}i|4k|uhd)(?![^\W_])", re.IGNORECASE)
+
+
 def parse_year(name):
     """
-    iterates through the name with a 4-length window looking for appropriate years
-    """
-
-    length, i, year = len(name), int(4), int()
-    while i < length + 1:
-        try:
-            int(name[i - 4:i])
-            if name[i].lower() != 'p' and name[i - 1] != ' ' and name[i - 4] != ' ' and i != 4:
-                year = name[i - 4:i]
-                if 1900 <= int(year) <= current_year:
-                    break
-                else:
-                    year = ""
-        except ValueError:
-            pass  # not integer
-        except IndexError:  # last iteration
-            try:
-                year = name[i - 4:i] if len(str(abs(int(name[i - 4:i])))) == 4 else ""
-                if 1900 <= int(year) <= current_year:
-                    break
-                else:
-                    year = ""
-            except ValueError:
-                year = ""
-        i += 1
-
-    return year if year != 0 else ""
+    finds the first year (between 1900 and the current year) in the name
+    """
+
+    for match in year_pattern.finditer(name):
+        if 1900 <= int(match.group(1)) <= current_year:
+            return match.group(1)
+
+    return ""
 
 
 def parse_resolution(name):
     """
-    iterates through the name with a 4-length window looking for a resolution
+    finds the first advertised resolution (e.g. 1080p, 4k, uhd or 1080i) in the name
     """
 
-    length, i, resolution = len(name), int(4), int()
-    while i < length + 1:  # finds advertised resolution of movie (if present)
-        try:
-            int(name[i - 4:i])
-            if name[i].lower() == 'p':
-                resolution = name[i - 4:i + 1].strip(' ')
-                return resolution.lower() if resolution != 0 else ""
-        except ValueError:
-            pass  # not an integer
-        except IndexError:  # no resolution (or at least not recorded with traditional 'p' (e.g. 1080p)
-            pass
-        i += 1
+    match = resolution_pattern.search(name) or extra_resolution_pattern.search(name)
+    if match is None:
+        return ""
 
-    return ""
+    return match.group(1).strip(' ').lower()
 
 
 def parse_name_pt2(name, year=None, resolution=None, source=None, edition=None):
@@ -211,57 +252,257 @@ def parse_roman_numerals(name):
     return parsed_name
 
 
-def process_files(files, folder_name=None):
+# bumped whenever parsing changes so that results cached by an older parser are discarded
+PARSER_VERSION = 3
+
+# the results of parse_part in order, parse_file prefixes those of the folder name with dir_
+part_fields = ["source", "source_tag", "year", "resolution", "edition", "edition_tag", "codec", "codec_tag", "name"]
+
+
+class ParsedFile(NamedTuple):
+    """the result of parsing a movie file (see parse_file), records rather than dicts as there is one per file"""
+
+    file_type: str
+    sample: bool
+    source: str
+    source_tag: str
+    year: str
+    resolution: str
+    edition: str
+    edition_tag: str
+    codec: str
+    codec_tag: str
+    name: str
+    dir_source: str
+    dir_source_tag: str
+    dir_year: str
+    dir_resolution: str
+    dir_edition: str
+    dir_edition_tag: str
+    dir_codec: str
+    dir_codec_tag: str
+    dir_name: str
+
+
+class ScannedMovie(NamedTuple):
+    """the flat (marked) representation of a scanned movie file"""
+
+    path: str
+    original_filename: str
+    title: str
+    year: str
+    file_type: str
+    resolution: str
+    sample: bool
+    source: str
+    edition: str
+    codec: str
+
+    def as_dict(self):
+        """the (json) representation of the movie"""
+
+        marked = self._asdict()
+        return {"marked": marked, "path": marked.pop("path")}
+
+
+parse_cache = ParseCache()
+
+
+def parse_file(item, folder_name, parsed=None):
     """
-    parses files and extracts as much information as possible
+    parses a single file (in the context of the folder containing it) and extracts as much information as possible
+    returns a ParsedFile (None if the file is not a movie file)
+
+    parsed optionally holds names already parsed ((name, is a folder): result of parse_part), see cached_parse_part
     """
 
-    for item, value in files.items():
-        if value:  # if directory
-            files[item] = process_files(value, folder_name=item)
-        else:
-            if item[-3:] in ['avi', 'mp4', 'mkv'] and "extra" not in folder_name.lower():
-                files[item] = {
-                    "file_type": item[-3:],
-                    "source": "",
-                    "sample": False
-                }
+    if not is_movie_file(item, folder_name):
+        return None
 
-                files[item]["source"], files[item]["source_tag"] = parse_source(item)
-                files[item]["dir_source"], files[item]["dir_source_tag"] = parse_source(folder_name)
+    return ParsedFile(item[-3:], "sample" in item.lower(), *cached_parse_part(item, parsed=parsed),
+                      *cached_parse_part(folder_name, folder=True, parsed=parsed))
 
-                name = parse_name(item)
-                folder_name = parse_name(folder_name)
 
-                files[item]["year"] = parse_year(name)
-                files[item]["dir_year"] = parse_year(folder_name)
+def is_movie_file(item, folder_name):
+    return item[-3:] in video_file_types and "extra" not in folder_name.lower()
 
-                files[item]["resolution"] = parse_resolution(name)
-                files[item]["dir_resolution"] = parse_resolution(folder_name)
 
-                files[item]["edition"], files[item]["edition_tag"] = parse_edition(item)
-                files[item]["dir_edition"], files[item]["dir_edition_tag"] = parse_edition(folder_name)
+def parse_part(name, folder=False):
+    """
+    parses a file or folder name on its own, returns a tuple of part_fields
+
+    a file's tags are all matched in its raw name, whereas a folder's edition and codec are matched once it has been
+    cleaned up by parse_name (so that the dots of "Alien.1979.Directors.Cut" don't hide its edition)
+    """
+
+    tags, name = parse_tags(name), parse_name(name)
+    if folder:
+        tags = (tags[0], *parse_tags(name)[1:])
+    (source, source_tag), (edition, edition_tag), (codec, codec_tag) = tags
 
-                files[item]["codec"], files[item]["codec_tag"] = parse_codec(item)
-                files[item]["dir_codec"], files[item]["dir_codec_tag"] = parse_codec(folder_name)
+    year, resolution = parse_year(name), parse_resolution(name)
 
-                if "sample" in item.lower():
-                    files[item]["sample"] = True
+    name = parse_name_pt2(name, year=year, resolution=resolution, source=source_tag, edition=edition_tag)
 
-                files[item]["name"] = parse_name_pt2(name,
-                                                     year=files[item]["year"],
-                                                     resolution=files[item]["resolution"],
-                                                     source=files[item]["source_tag"],
-                                                     edition=files[item]["edition_tag"])
-                files[item]["dir_name"] = parse_name_pt2(folder_name,
-                                                         year=files[item]["dir_year"],
-                                                         resolution=files[item]["dir_resolution"],
-                                                         source=files[item]["dir_source_tag"],
-                                                         edition=files[item]["dir_edition_tag"])
+    return source, source_tag, year, resolution, edition, edition_tag, codec, codec_tag, name
+
+
+def cached_parse_part(name, folder=False, parsed=None):
+    """
+    parse_part through the parse cache (file and folder names recur across scans, and folders across their files)
+
+    names in parsed (parsed by worker processes) are taken from it rather than the cache, which may have evicted them
+    """
+
+    result = parsed.get((name, folder)) if parsed else None
+    if result is None:
+        result = parse_cache.get((name, folder))
+    if result is None:
+        result = parse_part(name, folder)
+        parse_cache.set((name, folder), result)
+
+    return result
+
+
+def parse_parts(keys):
+    """parses (name, is a folder) keys"""
+
+    return [parse_part(name, folder) for name, folder in keys]
+
+
+def uncached_parts(pairs):
+    """
+    the distinct (name, is a folder) keys of the files and folders of the movie files in (filename, folder name) pairs
+    that are missing from the cache
+    """
+
+    keys = {key for item, folder_name in pairs if is_movie_file(item, folder_name)
+            for key in ((item, False), (folder_name, True))}
+    return [key for key in keys if key not in parse_cache]
+
+
+def parse_files(pairs, workers=None, chunk_size=1000, min_parallel=5000):
+    """
+    parses a batch of (filename, folder name) pairs, returning the result of parse_file for each of them (in order)
+
+    file and folder names are only parsed once (and not at all if they are in the parse cache), when at least
+    min_parallel need parsing they are split into chunks and parsed on a pool of worker processes (workers defaults to
+    the number of cores), smaller batches are parsed serially as starting the pool would cost more than it saves
+    """
+
+    pairs = list(pairs)
+
+    # the pool's results are used from here (the cache only keeps max_entries of them)
+    parsed = {}
+    keys = uncached_parts(pairs)
+    if workers != 1 and len(keys) >= min_parallel:
+        chunks = [keys[i:i + chunk_size] for i in range(0, len(keys), chunk_size)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for chunk, results in zip(chunks, executor.map(parse_parts, chunks)):
+                for key, result in zip(chunk, results):
+                    parsed[key] = result
+                    parse_cache.set(key, result)
+
+    return parse_file_chunk(pairs, parsed)
+
+
+def parse_file_chunk(pairs, parsed=None):
+    return [parse_file(item, folder_name, parsed) for item, folder_name in pairs]
+
+
+def iter_movies(entries, workers=1, chunk_size=1000, min_parallel=5000):
+    """
+    parse stage of the streaming scan pipeline, yields the flat (marked) representation of every movie found in
+    entries ((path, filename) pairs, see scanner.iter_source_files) in order
+
+    as with parse_files, the names missing from the parse cache are only parsed on a pool of worker processes once
+    there are at least min_parallel entries, with at most two chunks per worker in flight at a time
+    """
+
+    entries = iter(entries)
+    head = list(islice(entries, min_parallel))
+
+    chunks = chunked(chain(head, entries), chunk_size)
+    if workers == 1 or len(head) < min_parallel:
+        for chunk in chunks:
+            yield from mark_chunk(chunk, parse_file_chunk([(item, os.path.basename(path)) for path, item in chunk]))
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        for chunk in chunks:
+            pairs = [(item, os.path.basename(path)) for path, item in chunk]
+            keys = uncached_parts(pairs)
+            in_flight.append((chunk, pairs, keys, executor.submit(parse_parts, keys)))
+
+            if len(in_flight) >= 2 * (workers or os.cpu_count() or 1):
+                yield from mark_parsed_chunk(*in_flight.popleft())
+
+        while in_flight:
+            yield from mark_parsed_chunk(*in_flight.popleft())
+
+
+def mark_parsed_chunk(chunk, pairs, keys, future):
+    parsed = dict(zip(keys, future.result()))
+    for key, result in parsed.items():
+        parse_cache.set(key, result)
+
+    yield from mark_chunk(chunk, parse_file_chunk(pairs, parsed))
+
+
+def mark_chunk(chunk, parsed):
+    for (path, item), values in zip(chunk, parsed):
+        if values and not values.sample:
+            yield mark_movie(path, item, values)
+
+
+def chunked(iterable, size):
+    """splits iterable into lists of (at most) size items"""
+
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def process_files(files, folder_name=None, workers=1):
+    """
+    parses files and extracts as much information as possible
+
+    with workers other than 1 the files are parsed as a single batch (see parse_files)
+    """
+
+    if workers != 1:
+        leaves = list(iter_files(files, folder_name))
+        for (parent, item, _), values in zip(leaves, parse_files([leaf[1:] for leaf in leaves], workers=workers)):
+            if values:
+                parent[item] = values
+
+        return files
+
+    for item, value in files.items():
+        if value:  # if directory
+            files[item] = process_files(value, folder_name=item)
+        else:
+            parsed = parse_file(item, folder_name)
+            if parsed:
+                files[item] = parsed
 
     return files
 
 
+def iter_files(files, folder_name=None):
+    """yields (containing dictionary, filename, folder name) for every file in the nested structure"""
+
+    for item, value in files.items():
+        if value:  # if directory
+            yield from iter_files(value, folder_name=item)
+        else:
+            yield files, item, folder_name
+
+
 def flatten_movie_results(files, movies=None, _first_layer=True, _path=""):
     """
     filters out all movies from full list of extracted data and flattens the results
@@ -278,28 +519,13 @@ def flatten_movie_results(files, movies=None, _first_layer=True, _path=""):
         else:
             path = _path
 
-        if value and "name" not in value:
+        if value and isinstance(value, dict):
             files[item], movies = flatten_movie_results(value, movies, _first_layer=False, _path=path)
         else:
             if not movies:
                 movies = []
-            if value:
-                if not value["sample"]:
-                    dir_values = take_from_dir(value)
-                    movies.append({
-                        "marked": {
-                            "title": value["dir_name"] if dir_values else value["name"],
-                            "year": value["dir_year"] if dir_values else value["year"],
-                            "file_type": value["file_type"],
-                            "resolution": value["dir_resolution"] if dir_values else value["resolution"],
-                            "sample": value["sample"],
-                            "source": value["dir_source"] if dir_values else value["source"],
-                            "edition": value["dir_edition"] if dir_values else value["edition"],
-                            "codec": value["dir_codec"] if dir_values else value["codec"],
-                            "original_filename": item
-                        },
-                        "path": _path
-                    })
+            if value and not value.sample:
+                movies.append(mark_movie(_path, item, value))
 
     if _first_layer:
         return movies
@@ -307,36 +533,36 @@ def flatten_movie_results(files, movies=None, _first_layer=True, _path=""):
     return files, movies
 
 
-def take_from_dir(values):
-    """checks whether the movie details should be extracted from the filename or folder name"""
+def mark_movie(path, filename, values):
+    """builds the flat (marked) representation of a parsed movie file, a ScannedMovie"""
+
+    if take_from_dir(values):
+        return ScannedMovie(path, filename, values.dir_name, values.dir_year, values.file_type, values.dir_resolution,
+                            values.sample, values.dir_source, values.dir_edition, values.dir_codec)
 
-    file_score, dir_score = 0, 0
+    return ScannedMovie(path, filename, values.name, values.year, values.file_type, values.resolution, values.sample,
+                        values.source, values.edition, values.codec)
 
-    attributes = ["year", "resolution", "source", "edition"]
 
-    for attribute in attributes:
-        if values[attribute]:
-            file_score += 1
+def take_from_dir(values):
+    """checks whether the movie details should be extracted from the filename or folder name"""
 
-    for attribute in attributes:
-        if values["dir_" + attribute]:
-            dir_score += 1
+    file_score = bool(values.year) + bool(values.resolution) + bool(values.source) + bool(values.edition)
+    dir_score = bool(values.dir_year) + bool(values.dir_resolution) + bool(values.dir_source) + bool(values.dir_edition)
 
     return dir_score > file_score
 
 
-def get_flat_movies(*sources):
-    """retrieves list of all movies in selected sources in a flat format"""
+def files_as_dicts(files):
+    """the nested structure of files (see process_files) with the parsed files as dicts (for json)"""
 
-    files = {}
-    for source in sources:
-        key = source.address[:source.address.rfind("\\")]
-        if key not in files:
-            files[key] = {}
+    return {item: files_as_dicts(value) if isinstance(value, dict) else value._asdict() if value else value
+            for item, value in files.items()}
 
-        files[source.address[:source.address.rfind("\\")]].update(get_directory_structure(source.address))
 
-    process_files(files)
+def get_flat_movies(*sources, workers=1, timeout=None, parse_workers=1):
+    """retrieves list of all movies in selected sources in a flat format"""
 
-    movie_list = flatten_movie_results(files)
-    return sorted(movie_list, key=lambda key: key["marked"]["year"].lower()) if movie_list else []
+    movie_list = list(iter_movies(iter_source_files([source.address for source in sources], workers=workers,
+                                                    timeout=timeout), workers=parse_workers))
+    return sorted(movie_list, key=lambda movie: movie.year.lower()) if movie_list else []
@@ -0,0 +1,203 @@
+"""
+long running watcher that stores changes to the sources as they happen - with inotify on linux (falling back to
+polling with the incremental scan elsewhere), debouncing bursts of changes and only rescanning the directories affected
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+from headless import init_headless, session, setting
+from models import Source
+from store import incremental_scan_and_store, rescan_directories
+
+logger = logging.getLogger(__name__)
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+# file contents are only picked up once they are closed (rather than on every write of a file being copied)
+watch_mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+event_header = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    """
+    watches every directory below roots with inotify (new directories are watched as they appear)
+    raises OSError if inotify isn't available or the watch limit is reached
+    """
+
+    def __init__(self, roots):
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError(errno.ENOSYS, "libc not found")
+
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.roots = roots
+        self.paths = {}  # watch descriptor: directory path
+
+        try:
+            for root in roots:
+                self.watch_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def watch_tree(self, root):
+        """watches root and every directory below it"""
+
+        self.watch(root)
+        for path, subdirectories, _ in os.walk(root):
+            for subdirectory in subdirectories:
+                self.watch(os.path.join(path, subdirectory))
+
+    def watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), watch_mask | IN_ONLYDIR)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                return  # removed (or replaced) since it was listed, the event for that is still to come
+            raise OSError(error, f"failed to watch {path}: {os.strerror(error)}")
+
+        # watching a directory again (e.g. after it was moved) returns its existing descriptor
+        self.paths[wd] = path
+
+    def read(self, timeout=None):
+        """
+        waits up to timeout seconds (forever if None) for changes, returns the set of directories whose contents changed
+        (empty if there were none)
+        """
+
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+
+        data = b""
+        while True:
+            try:
+                chunk = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            data += chunk
+
+        changed, offset = set(), 0
+        while offset < len(data):
+            wd, mask, _, length = event_header.unpack_from(data, offset)
+            name = data[offset + event_header.size:offset + event_header.size + length].rstrip(b"\0")
+            offset += event_header.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                # events were dropped, so everything has to be checked
+                logger.warning("inotify queue overflowed, rescanning the sources")
+                changed.update(self.roots)
+                continue
+
+            path = self.paths.get(wd)
+            if path is None:
+                continue
+
+            if mask & IN_IGNORED:
+                del self.paths[wd]
+                continue
+
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                # its parent has an event of its own unless it is a root
+                changed.add(os.path.dirname(path) if path not in self.roots else path)
+                continue
+
+            changed.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.watch_tree(os.path.join(path, os.fsdecode(name)))
+
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def watch(sources, debounce=2.0, max_delay=30.0, poll_interval=60.0, workers=1, timeout=None, parse_workers=1,
+          batch_size=1000):
+    """
+    stores changes to sources as they happen, changes are stored once there have been none for debounce seconds (or
+    max_delay seconds after the first, so a constant stream of changes is still stored)
+
+    falls back to an incremental scan every poll_interval seconds if inotify can't be used
+    workers and timeout control the concurrent walks of the sources or changed directories (see scanner.run_walks)
+    """
+
+    roots = [source.address.rstrip(os.sep) for source in sources]
+
+    # catches up on whatever changed while nothing was watching
+    incremental_scan_and_store(*sources, workers=workers, timeout=timeout, parse_workers=parse_workers,
+                               batch_size=batch_size)
+    session.remove()
+
+    try:
+        watcher = InotifyWatcher([root for root in roots if os.path.isdir(root)])
+    except OSError as e:
+        logger.warning("can't watch the sources (%s), polling every %s seconds instead", e, poll_interval)
+        poll(poll_interval, workers, timeout, parse_workers, batch_size)
+        return
+
+    logger.info("watching %s directories", len(watcher.paths))
+
+    try:
+        while True:
+            changed = watcher.read()
+
+            deadline = time.monotonic() + max_delay
+            while time.monotonic() < deadline:
+                more = watcher.read(timeout=min(debounce, max(0.0, deadline - time.monotonic())))
+                if not more:
+                    break
+                changed |= more
+
+            logger.info("rescanning %s changed directories", len(changed))
+            rescan_directories(changed, roots, workers=workers, timeout=timeout, parse_workers=parse_workers,
+                               batch_size=batch_size)
+            session.remove()
+    finally:
+        watcher.close()
+
+
+def poll(interval, workers=1, timeout=None, parse_workers=1, batch_size=1000):
+    """incrementally scans the sources every interval seconds"""
+
+    while True:
+        time.sleep(interval)
+
+        incremental_scan_and_store(*session.query(Source).all(), workers=workers, timeout=timeout,
+                                   parse_workers=parse_workers, batch_size=batch_size)
+        session.remove()
+
+
+if __name__ == '__main__':
+    init_headless()
+    logging.basicConfig(level=logging.INFO)
+
+    watch(session.query(Source).all(), debounce=setting("WATCH_DEBOUNCE"), max_delay=setting("WATCH_MAX_DELAY"),
+          poll_interval=setting("WATCH_POLL_INTERVAL"), workers=setting("SCAN_WORKERS"),
+          timeout=setting("SCAN_TIMEOUT"), parse_workers=setting("PARSE_WORKERS"),
+          batch_size=setting("SCAN_BATCH_SIZE"))